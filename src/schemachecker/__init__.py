@@ -4,3 +4,4 @@ from . import pfr
 from . import stat
 from . import fss
 from . import rar
+from . import batch
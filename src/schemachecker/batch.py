@@ -0,0 +1,88 @@
+import gc
+import os
+import multiprocessing
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple, Union
+
+# Проверщик и загрузчик файлов пакета проверок в процессе воркера.
+# Передаются инициализатору пула (initargs), при fork аргументы процесса
+# наследуются без pickle вместе с компендиумом. В родительском процессе
+# не используются, поэтому пакетные проверки могут выполняться одновременно
+_checker = None
+_loader = None
+
+# Число выполняющихся пакетных проверок родительского процесса:
+# gc.unfreeze выполняется после завершения последней из них
+_active = 0
+_active_lock = Lock()
+
+
+def _init_worker(checker: Any, loader: Union[Callable[[Any], Any], None]) -> None:
+    """ Инициализация воркера, например, переподключение к внешним сервисам. """
+    global _checker, _loader
+
+    _checker, _loader = checker, loader
+    init_worker = getattr(_checker, 'init_worker', None)
+    if init_worker is not None:
+        init_worker()
+
+
+def _check_item(item: Any) -> Tuple[Any, Dict[str, Any]]:
+    """ Проверка одного файла в воркере. """
+    try:
+        file = _loader(item) if _loader is not None else item
+        _checker.check_file(file)
+        verify_result = file.verify_result
+    except Exception as ex:
+        verify_result = {
+            'result':       'error',
+            'description':  str(ex),
+            'asserts':      []
+        }
+
+    # Исключения проверщиков не всегда восстанавливаются pickle,
+    # в родительский процесс описание передаётся строкой
+    description = verify_result.get('description')
+    if description is not None and not isinstance(description, str):
+        verify_result['description'] = str(description)
+
+    return item, verify_result
+
+
+def check_files(checker: Any, items: Iterable[Any], *,
+                loader: Callable[[Any], Any] = None,
+                workers: int = None,
+                chunksize: int = 1) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+    """
+    Пакетная проверка файлов в пуле процессов.
+    Компендиум собирается один раз в родительском процессе (checker.setup_compendium
+    должен быть вызван заранее), воркеры получают его при fork без копирования.
+    Перед fork выполняется gc.freeze, чтобы сборщик мусора в воркерах не изменял
+    счётчики объектов компендиума и страницы памяти оставались общими.
+    :param checker: проверщик с собранным компендиумом.
+    :param items: описания файлов (например, пути), передаются воркерам через pickle.
+    :param loader: функция, создающая из описания объект файла для check_file.
+        Вызывается в воркере, разбор xml не нагружает родительский процесс.
+        Если не задана, описание передаётся в check_file как есть.
+    :param workers: число воркеров, по умолчанию - число ядер.
+    :param chunksize: число файлов, передаваемых воркеру за раз.
+    :return: итератор пар (описание файла, verify_result) в порядке завершения проверок.
+        Исключение при проверке файла возвращается как результат 'error' с описанием.
+    """
+    global _active
+
+    context = multiprocessing.get_context('fork')
+
+    with _active_lock:
+        _active += 1
+        gc.collect()
+        gc.freeze()
+    try:
+        with context.Pool(workers or os.cpu_count(), initializer=_init_worker,
+                          initargs=(checker, loader)) as pool:
+            yield from pool.imap_unordered(_check_item, items, chunksize)
+    finally:
+        with _active_lock:
+            _active -= 1
+            if not _active:
+                gc.unfreeze()
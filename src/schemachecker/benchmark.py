@@ -0,0 +1,58 @@
+"""
+Микробенчмарк лексеров: скорость токенизации выражений (expr/sec).
+Запуск: python -m schemachecker.benchmark {fns,stat} <файл выражений> [--packrat]
+Файл содержит по одному выражению в строке (Schematron-выражения ФНС
+или контрольные соотношения статистики). Первый проход разбирает выражения
+грамматикой, второй получает их из кэша токенизации.
+"""
+import argparse
+from time import time
+from typing import Callable, List
+
+
+def tokenize_benchmark(tokenize: Callable[[str], List], exprs: List[str]) -> float:
+    """ Токенизация списка выражений, возвращает число выражений в секунду. """
+    nerrors = 0
+    start_time = time()
+
+    for expr in exprs:
+        try:
+            tokenize(expr)
+        except Exception:
+            nerrors += 1
+
+    end_time = time() - start_time
+    print(f'Elapsed time: {round(end_time, 4)}; lines: {len(exprs)}; errors: {nerrors};'
+          f' expr/sec: {round(len(exprs) / end_time, 4)}')
+    return len(exprs) / end_time
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__,
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('kind', choices=('fns', 'stat'))
+    arg_parser.add_argument('file')
+    arg_parser.add_argument('--packrat', action='store_true')
+    args = arg_parser.parse_args()
+
+    with open(args.file, 'r') as handler:
+        exprs = [line.strip() for line in handler if line.strip()]
+
+    if args.kind == 'fns':
+        from .fns.tokenizer import Tokenizer
+        tokenizer = Tokenizer(args.packrat)
+        grammar = tokenizer.create_tokenizer()
+    else:
+        from .stat.tokenizer import Tokenizer
+        tokenizer = Tokenizer(args.packrat)
+        _, grammar, _ = tokenizer.create_tokenizer()
+        exprs = [expr.lower() for expr in exprs]
+
+    print('Parsing:')
+    tokenize_benchmark(lambda expr: tokenizer.tokenize_expression(expr, grammar), exprs)
+    print('Cached:')
+    tokenize_benchmark(lambda expr: tokenizer.tokenize_expression(expr, grammar), exprs)
+
+
+if __name__ == '__main__':
+    main()
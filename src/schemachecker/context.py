@@ -0,0 +1,151 @@
+import os
+from io import BytesIO
+from typing import Any, ClassVar, Dict, IO, List, Tuple, Union
+# noinspection PyUnresolvedReferences
+from lxml import etree
+from .xsd import XsdScheme
+
+# Порог размера файла (байт), начиная с которого XSD проверка выполняется потоково
+STREAM_THRESHOLD = 64 * 1024 * 1024
+
+# Маркер усечения списка ошибок по лимиту max_errors
+TRUNCATION_MESSAGE = 'Превышен лимит числа ошибок, остальные ошибки не выводятся'
+
+
+class CheckContext:
+    """
+    Состояние проверки одного файла.
+    Создаётся на каждый вызов check_file, проверщик хранит только компендиум,
+    общий для всех проверок. Благодаря этому один экземпляр проверщика
+    может проверять несколько файлов одновременно из разных потоков.
+
+    Файлы больше stream_threshold проверяются потоково: дерево файла
+    (file.xml_tree) не запрашивается до проверки по XSD, для определения
+    схемы разбирается только начало документа (см. head).
+    Источником для потокового разбора служит путь к файлу (file.path),
+    при его отсутствии - содержимое файла (file.content).
+
+    max_errors - лимит числа ошибок в результате проверки (1 - остановка
+    на первой ошибке), None - без ограничения. См. limit_errors.
+    """
+    def __init__(self, file: ClassVar[Dict[str, Any]],
+                 stream_threshold: Union[int, None] = None,
+                 max_errors: Union[int, None] = None) -> None:
+        # Проверяемый файл, в него записывается результат проверки
+        self.file = file
+        self.filename: str = file.filename
+        self._xml_content: etree.ElementTree = None
+        # Разобранное начало документа по имени искомого элемента
+        self._heads: Dict[Union[str, None], etree.Element] = dict()
+
+        self.max_errors = max_errors
+        # Число ошибок, записанных в результат, и признак усечения списка ошибок
+        self.reported = 0
+        self.truncated = False
+
+        size = self._get_size()
+        self.streaming = (stream_threshold is not None
+                          and size is not None
+                          and size > stream_threshold)
+
+    @property
+    def xml_content(self) -> etree.ElementTree:
+        """ Дерево файла, запрашивается у файла при первом обращении. """
+        if self._xml_content is None:
+            self._xml_content = self.file.xml_tree
+        return self._xml_content
+
+    def _get_size(self) -> Union[int, None]:
+        """ Размер файла, None - размер неизвестен. """
+        path = getattr(self.file, 'path', None)
+        if path is not None:
+            return os.path.getsize(path)
+        content = getattr(self.file, 'content', None)
+        if content is not None:
+            return len(content)
+        return None
+
+    def get_source(self) -> Tuple[Union[str, IO], Dict[str, Any]]:
+        """ Источник потокового разбора и параметры etree.iterparse. """
+        path = getattr(self.file, 'path', None)
+        if path is not None:
+            return path, {}
+        content = self.file.content
+        if isinstance(content, str):
+            # Декларация кодировки не соответствует перекодированному содержимому
+            return BytesIO(content.encode('utf-8')), {'encoding': 'utf-8'}
+        return BytesIO(content), {}
+
+    def head(self, localname: str = None) -> etree.Element:
+        """
+        Корневой элемент начала документа, разобранного до конца
+        первого элемента с локальным именем localname (включительно).
+        Без localname разбирается только открывающий тег корня.
+        Вне потокового режима возвращается корень полного дерева.
+        """
+        if not self.streaming:
+            return self.xml_content
+
+        if localname not in self._heads:
+            source, options = self.get_source()
+            root = None
+            for event, element in etree.iterparse(source, events=('start', 'end'),
+                                                  remove_comments=True, huge_tree=True,
+                                                  **options):
+                if root is None:
+                    root = element
+                if localname is None:
+                    break
+                if event == 'end' and etree.QName(element).localname == localname:
+                    break
+            self._heads[localname] = root
+
+        return self._heads[localname]
+
+    @property
+    def errors_left(self) -> Union[int, None]:
+        """ Сколько ещё ошибок можно записать в результат, None - без ограничения. """
+        if self.max_errors is None:
+            return None
+        return max(self.max_errors - self.reported, 0)
+
+    def limit_errors(self, errors: List[Any], more: bool = False) -> List[Any]:
+        """
+        Ошибки для записи в результат в пределах лимита max_errors.
+        more - кроме errors есть ещё ошибки, которые не формировались.
+        При превышении лимита в результат записывается признак truncated,
+        а после последней ошибки добавляется маркер усечения в том же виде,
+        что и ошибки: кортеж (код, описание) или структура ошибки.
+        """
+        if self.max_errors is None:
+            return errors
+        if self.truncated:
+            return []
+
+        left = self.errors_left
+        if len(errors) <= left and not more:
+            self.reported += len(errors)
+            return errors
+
+        self.reported = self.max_errors
+        self.truncated = True
+        self.file.verify_result['truncated'] = True
+        if errors and isinstance(errors[0], dict):
+            marker = {'error_code': '', 'description': TRUNCATION_MESSAGE, 'inspection_items': []}
+        else:
+            marker = ('', TRUNCATION_MESSAGE)
+        return [*errors[:left], marker]
+
+    def reset_errors(self) -> None:
+        """ Сброс счётчика ошибок при перезаписи результата проверки. """
+        self.reported = 0
+        self.truncated = False
+        self.file.verify_result.pop('truncated', None)
+
+    def assert_valid(self, xsd_scheme: XsdScheme) -> None:
+        """ Проверка файла по XSD схеме, потоковая для больших файлов. """
+        if self.streaming:
+            source, options = self.get_source()
+            xsd_scheme.assert_valid_stream(source, **options)
+        else:
+            xsd_scheme.assert_valid(self.xml_content)
@@ -1,22 +1,23 @@
 import os
+from itertools import islice
 # noinspection PyUnresolvedReferences
 from lxml import etree
-from typing import List, Tuple, ClassVar, Dict, Any
+from typing import List, Tuple, ClassVar, Dict, Any, Union
 from .exceptions import *
+from ..context import CheckContext
+from ..xsd import XsdScheme
 
 
 class EdoChecker:
-    def __init__(self, *, root):
+    def __init__(self, *, root, max_errors: Union[int, None] = None):
         self.parser = etree.XMLParser(encoding='cp1251', remove_comments=True)
         self.root = root
+        # Лимит числа ошибок в результате проверки файла, None - без ограничения
+        self.max_errors = max_errors
 
         # Компендиум проверочных схем
         self.compendium = dict()
 
-        # Данные файла
-        self.filename = None
-        self.xml_content = None
-
     @staticmethod
     def _set_error_struct(err_list: List[Tuple[str, str]], file: ClassVar[Dict[str, Any]]) -> None:
         """ Заполнение структуры ошибки для вывода. """
@@ -28,10 +29,11 @@ class EdoChecker:
                 'inspection_items': element_objs
             })
 
-    def _check_filename(self) -> Tuple[bool, str]:
+    @staticmethod
+    def _check_filename(ctx: CheckContext) -> Tuple[bool, str]:
         """ Метод проверяет соответствие имени файла и атрибута ИдФайл. """
-        filename = self.filename.split('.')[0]
-        attr_filename = self.xml_content.attrib['ИдФайл']
+        filename = ctx.filename.split('.')[0]
+        attr_filename = ctx.xml_content.attrib['ИдФайл']
         return filename == attr_filename, attr_filename
 
     def setup_compendium(self) -> None:
@@ -46,14 +48,17 @@ class EdoChecker:
                     try:
                         xsd_name = '_'.join(filename.split('_')[:2])
                         xsd_content = etree.parse(handler, self.parser).getroot()
-                        xsd_scheme = etree.XMLSchema(xsd_content)
+                        xsd_scheme = XsdScheme(xsd_content)
                         self.compendium[xsd_name] = xsd_content, xsd_scheme
                     except etree.XMLSyntaxError as ex:
                         raise XsdSchemeError(ex)
 
     def check_file(self, file: ClassVar[Dict[str, Any]]) -> None:
-        self.filename = file.filename
-        self.xml_content = file.xml_tree
+        """
+        Проверка файла. Состояние проверки хранится в CheckContext,
+        метод можно вызывать одновременно из нескольких потоков.
+        """
+        ctx = CheckContext(file, max_errors=self.max_errors)
 
         file.verify_result = dict()
 
@@ -61,28 +66,31 @@ class EdoChecker:
         file.verify_result['asserts'] = []
 
         # Определение проверочной схемы
-        prefix = '_'.join(self.filename.split('_')[:2])
+        prefix = '_'.join(ctx.filename.split('_')[:2])
         if 'mark' in prefix.lower() or 'pros' in prefix.lower():
             prefix = prefix[:-4]
         xsd_content, xsd_scheme = self.compendium[prefix]
 
         # Проверка имени файла
-        correct_filename, attr_filename = self._check_filename()
+        correct_filename, attr_filename = self._check_filename(ctx)
         ret_list = []
         if not correct_filename:
             file.verify_result['result'] = 'failed_sch'
             ret_list.append((
                 '0400400007',
-                f'Имя файла обмена {self.filename} не совпадает со значением '
+                f'Имя файла обмена {ctx.filename} не совпадает со значением '
                 f'атрибута ИдФайл {attr_filename}'
             ))
 
         # Проверка по xsd
         try:
-            xsd_scheme.assertValid(self.xml_content)
-        except etree.DocumentInvalid:
+            xsd_scheme.assert_valid(ctx.xml_content)
+        except etree.DocumentInvalid as ex:
             file.verify_result['result'] = 'failed_xsd'
-            for error in xsd_scheme.error_log:
+            # Сверх лимита достаточно одной ошибки, чтобы отметить усечение
+            error_log = ex.error_log if ctx.errors_left is None \
+                else islice(ex.error_log, ctx.errors_left - len(ret_list) + 1)
+            for error in error_log:
                 ret_list.append((str(error.line), error.message))
 
-        self._set_error_struct(ret_list, file)
+        self._set_error_struct(ctx.limit_errors(ret_list), file)
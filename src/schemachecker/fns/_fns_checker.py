@@ -56,6 +56,13 @@ class SchemaChecker(local):
             'concat':       self._concat_func
         }
 
+        # Логические операторы с сокращённым вычислением:
+        # значение левого операнда, при котором правый не вычисляется
+        self._short_circuit_map = {
+            'and':          False,
+            'or':           True
+        }
+
         self._verbose = verbose
 
         self._local_data = local()
@@ -275,10 +282,45 @@ class SchemaChecker(local):
             # Работаем с элементом, возвращаем наличие
             return True if value else False
 
+    def _subtree_start(self, end):
+        """ Индекс начала поддерева стека, вершина которого находится в позиции end - 1. """
+        stack = self._local_data.stack
+        end -= 1
+        op = stack[end]
+
+        if op in self._unary_map:
+            return end - 1 if op == 'count' else self._subtree_start(end)
+        elif op in self._binary_map:
+            return self._subtree_start(self._subtree_start(end))
+        elif op in self._ternary_map:
+            end = self._subtree_start(end)
+            if op == 'substring' and not stack[end - 1].isdigit():
+                # substring без опционального третьего аргумента
+                return self._subtree_start(end)
+            return self._subtree_start(self._subtree_start(end))
+        elif op in self._varargs_map:
+            while end and set(stack[end - 1]) <= self._element:
+                end = self._subtree_start(end)
+
+        return end
+
     def _evaluate_stack(self):
         op = self._local_data.stack.pop()
 
-        if op in self._nullary_map:
+        if op in self._short_circuit_map:
+            # Правый операнд снимаем со стека и вычисляем только при необходимости,
+            # ошибки в невычисленной ветви не возникают
+            stack = self._local_data.stack
+            start = self._subtree_start(len(stack))
+            right = stack[start:]
+            del stack[start:]
+            arg1 = self._evaluate_stack()
+            if bool(arg1) == self._short_circuit_map[op]:
+                return bool(arg1)
+            self._local_data.stack.extend(right)
+            arg2 = self._evaluate_stack()
+            return self._binary_map[op](arg1, arg2)
+        elif op in self._nullary_map:
             return self._nullary_map[op]()
         elif op in self._unary_map:
             if op == 'count':
@@ -6,6 +6,7 @@ from lxml import etree
 from functools import wraps
 from pyparsing import Word, Literal, ZeroOrMore, Forward, Keyword,\
     Combine, Group, Suppress, Optional, oneOf, srange, nums
+from .columnar import ColumnStore
 
 
 class AdditionTokenizer:
@@ -95,6 +96,8 @@ class AdditionEvaluator:
 
         self.stack = []
         self._content = None
+        # Колонки атрибутов документа для вычисления sum без XPath
+        self.columns = None
 
     @property
     def content(self):
@@ -103,6 +106,7 @@ class AdditionEvaluator:
     @content.setter
     def content(self, xml_content):
         self._content = xml_content
+        self.columns = ColumnStore(xml_content)
 
     def rounder(self, op):
         """
@@ -124,6 +128,12 @@ class AdditionEvaluator:
         op = self.stack.pop()
 
         if op in self.unary_map:
+            if op == 'sum':
+                # Аргумент sum - путь XPath, по возможности вычисляем по колонкам
+                value = self.columns.sum(self.stack[-1])
+                if value is not None:
+                    self.stack.pop()
+                    return round(value, 2)
             arg = self._evaluate_stack()
             return self.unary_map[op](arg)
 
@@ -0,0 +1,237 @@
+import re
+import numpy as np
+from typing import Dict, List, Tuple, Union
+# noinspection PyUnresolvedReferences
+from lxml import etree
+from .index import DocumentIndex
+
+# Имя элемента или атрибута (без осей, подстановок и пространств имён)
+_name = re.compile(r'[^\[\]@/*:.()\s"\'=<>!]+')
+# Шаг пути с необязательным предикатом
+_step = re.compile(r'(?P<name>[^\[\]@/*:.()\s"\'=<>!]+)(?:\[(?P<predicate>[^\[\]]+)\])?')
+# Сравнение атрибута с литералом: @Месяц="05", @Месяц<6
+_comparison = re.compile(r'\s*@(?P<key>[^\[\]@/*:.()\s"\'=<>!]+)\s*(?P<op><=|>=|!=|=|<|>)\s*'
+                         r'(?P<literal>"[^"]*"|\'[^\']*\'|-?\d+(?:\.\d+)?)\s*')
+# Число в записи, которую принимает number() в libxml2 (lxml): без знака +,
+# inf, nan и разделителей разрядов, с необязательным показателем степени
+_number = re.compile(r'[ \t\r\n]*-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?[ \t\r\n]*')
+
+# Операции сравнения XPath над колонками
+_op_map = {
+    '=':    np.equal,
+    '!=':   np.not_equal,
+    '<':    np.less,
+    '<=':   np.less_equal,
+    '>':    np.greater,
+    '>=':   np.greater_equal
+}
+
+# Разобранный путь суммы: шаги (None - '//'), предикат последнего шага, атрибут
+_SumPath = Tuple[Tuple[Union[str, None], ...], Union[Tuple[str, List[Tuple[str, str, str]]], None], str]
+
+
+def _match_steps(path: Tuple[str, ...], steps: Tuple[Union[str, None], ...]) -> bool:
+    """ Соответствие полного пути элемента шагам абсолютного пути XPath. """
+    if not steps:
+        return not path
+    if steps[0] is None:
+        return any(_match_steps(path[idx:], steps[1:]) for idx in range(len(path) + 1))
+    return bool(path) and path[0] == steps[0] and _match_steps(path[1:], steps[1:])
+
+
+def _to_number(value: Union[str, None]) -> float:
+    """ Приведение строки к числу по правилам XPath 1.0 (NaN для нечисловых значений). """
+    if value is None or _number.fullmatch(value) is None:
+        return np.nan
+    return float(value)
+
+
+class ColumnStore:
+    """
+    Колоночное представление документа для вычисления sum() интерпретатором
+    Schematron-выражений (Interpreter) и в AdditionEvaluator.
+    Элементы документа индексируются за один проход (DocumentIndex) или
+    берутся из готового индекса, в том числе проекции документа (ProjectedIndex).
+    Значения атрибутов элементов одного пути собираются в массивы numpy
+    при первом обращении. Сумма sum(/a/b[@Месяц="05"]/@Сум) вычисляется как свёртка
+    по маске предиката, а для предикатов вида @k="x" or @k="y" - по заранее
+    посчитанным суммам групп значений ключа, общим для всех выражений.
+    Поддерживаются абсолютные пути из простых шагов с предикатом последнего шага
+    из сравнений атрибутов с литералами (только or или только and), нечисловое
+    значение атрибута даёт NaN, как в XPath. Для остальных выражений
+    sum возвращает None и вычисляется через XPath, поэтому проекция документа
+    строится только для планов, суммы которых поддерживаются (supports).
+    """
+    def __init__(self, xml_content: Union[etree.ElementTree, DocumentIndex]) -> None:
+        self.xml_content = xml_content
+        # Индекс документа, для дерева строится при первом обращении
+        self._index: DocumentIndex = xml_content if isinstance(xml_content, DocumentIndex) else None
+
+        # Разобранные выражения
+        self._sum_paths: Dict[str, Union[_SumPath, None]] = dict()
+        # Полные пути элементов по шагам пути
+        self._paths: Dict[Tuple[Union[str, None], ...], List[Tuple[str, ...]]] = dict()
+        # Колонки значений: (шаги, атрибут) -> (числа, признак наличия атрибута)
+        self._values: Dict[Tuple[Tuple[Union[str, None], ...], str], Tuple[np.ndarray, np.ndarray]] = dict()
+        # Колонки ключей: (шаги, атрибут) -> строковые значения (None - атрибут отсутствует)
+        self._keys: Dict[Tuple[Tuple[Union[str, None], ...], str], np.ndarray] = dict()
+        # Суммы групп: (шаги, атрибут значений, атрибут ключа) -> {значение ключа: сумма}
+        self._groups: Dict[Tuple[Tuple[Union[str, None], ...], str, str], Dict[str, float]] = dict()
+
+    @staticmethod
+    def _parse(expr: str) -> Union[_SumPath, None]:
+        """ Разбор пути суммы. None - путь не поддерживается колоночным вычислением. """
+        path, sep, attr = expr.strip().rpartition('/@')
+        if not sep or not path.startswith('/') or not _name.fullmatch(attr):
+            return None
+
+        steps = []
+        predicate = None
+        chunks = path.split('/')[1:]
+        for idx, chunk in enumerate(chunks):
+            if not chunk:
+                # Пустой шаг между разделителями - ось descendant-or-self ('//')
+                if steps and steps[-1] is None or idx == len(chunks) - 1:
+                    return None
+                steps.append(None)
+                continue
+
+            match = _step.fullmatch(chunk)
+            if match is None:
+                return None
+            if match.group('predicate') is not None:
+                # Предикат допускается только у последнего шага
+                if idx != len(chunks) - 1:
+                    return None
+                predicate = ColumnStore._parse_predicate(match.group('predicate'))
+                if predicate is None:
+                    return None
+            steps.append(match.group('name'))
+
+        return tuple(steps), predicate, attr
+
+    @staticmethod
+    def _parse_predicate(predicate: str) -> Union[Tuple[str, List[Tuple[str, str, str]]], None]:
+        """ Разбор предиката на логическую связку и список сравнений (ключ, операция, литерал). """
+        for conjunction in ('or', 'and'):
+            terms = re.split(rf'\s+{conjunction}\s+', predicate)
+            if len(terms) > 1 or conjunction == 'and':
+                break
+
+        comparisons = []
+        for term in terms:
+            match = _comparison.fullmatch(term)
+            if match is None:
+                return None
+            comparisons.append((match.group('key'), match.group('op'), match.group('literal')))
+
+        return conjunction, comparisons
+
+    def _get_paths(self, steps: Tuple[Union[str, None], ...]) -> List[Tuple[str, ...]]:
+        if steps not in self._paths:
+            if self._index is None:
+                self._index = DocumentIndex.from_tree(self.xml_content)
+            self._paths[steps] = [path for path in self._index.ordinals if _match_steps(path, steps)]
+        return self._paths[steps]
+
+    def _get_column(self, steps: Tuple[Union[str, None], ...], attr: str) -> List[Union[str, None]]:
+        """
+        Значения атрибута у элементов пути (None - атрибут отсутствует).
+        KeyError - значения атрибута не собраны в проекции документа.
+        """
+        return [value for path in self._get_paths(steps) for value in self._index.column(path, attr)]
+
+    def _get_values(self, steps: Tuple[Union[str, None], ...], attr: str) -> Tuple[np.ndarray, np.ndarray]:
+        """ Колонка числовых значений атрибута, NaN - значение не является числом. """
+        key = (steps, attr)
+        if key not in self._values:
+            values = self._get_column(steps, attr)
+            present = np.array([value is not None for value in values], dtype=bool)
+            numbers = np.array([_to_number(value) if value is not None else 0. for value in values], dtype=float)
+            self._values[key] = numbers, present
+        return self._values[key]
+
+    def _get_keys(self, steps: Tuple[Union[str, None], ...], attr: str) -> np.ndarray:
+        key = (steps, attr)
+        if key not in self._keys:
+            self._keys[key] = np.array(self._get_column(steps, attr), dtype=object)
+        return self._keys[key]
+
+    def _get_groups(self, steps: Tuple[Union[str, None], ...], attr: str, key_attr: str) -> Dict[str, float]:
+        """ Суммы значений атрибута attr по группам значений ключа key_attr. """
+        key = (steps, attr, key_attr)
+        if key not in self._groups:
+            numbers, present = self._get_values(steps, attr)
+            keys = self._get_keys(steps, key_attr)
+            mask = present & (keys != None)
+            groups, inverse = np.unique(keys[mask].astype(str), return_inverse=True)
+            sums = np.bincount(inverse, weights=numbers[mask], minlength=len(groups))
+            self._groups[key] = dict(zip(groups.tolist(), sums.tolist()))
+        return self._groups[key]
+
+    def _get_mask(self, steps: Tuple[Union[str, None], ...],
+                  conjunction: str,
+                  comparisons: List[Tuple[str, str, str]]) -> np.ndarray:
+        """ Маска элементов, удовлетворяющих предикату. """
+        masks = []
+        for key_attr, op, literal in comparisons:
+            keys = self._get_keys(steps, key_attr)
+            present = keys != None
+            if literal[0] in '"\'' and op in ('=', '!='):
+                # Сравнение строк
+                values = np.where(present, keys, '')
+                mask = _op_map[op](values.astype(str), literal[1:-1])
+            else:
+                # Сравнение чисел, NaN не равен ничему
+                numbers = np.array([_to_number(value) for value in keys], dtype=float)
+                literal = _to_number(literal[1:-1] if literal[0] in '"\'' else literal)
+                with np.errstate(invalid='ignore'):
+                    mask = _op_map[op](numbers, literal)
+                if op == '!=':
+                    mask &= ~np.isnan(numbers)
+            masks.append(mask & present)
+
+        if conjunction == 'or':
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    @classmethod
+    def supports(cls, expr: str) -> bool:
+        """ Вычисляется ли sum(expr) по колонкам, без дерева документа. """
+        return cls._parse(expr) is not None
+
+    def sum(self, expr: str) -> Union[float, None]:
+        """
+        Аналог sum(expr) над атрибутами. None - выражение не поддерживается
+        или колонка не собрана в проекции, нужно вычисление через XPath.
+        """
+        if expr not in self._sum_paths:
+            self._sum_paths[expr] = self._parse(expr)
+        sum_path = self._sum_paths[expr]
+        if sum_path is None:
+            return None
+
+        steps, predicate, attr = sum_path
+        try:
+            numbers, present = self._get_values(steps, attr)
+            if predicate is not None:
+                for key_attr, _, _ in predicate[1]:
+                    self._get_keys(steps, key_attr)
+        except KeyError:
+            self._sum_paths[expr] = None
+            return None
+
+        if predicate is None:
+            return float(numbers[present].sum())
+
+        conjunction, comparisons = predicate
+        key_attrs = {key_attr for key_attr, _, _ in comparisons}
+        if (conjunction == 'or' or len(comparisons) == 1) and len(key_attrs) == 1 \
+                and all(op == '=' and literal[0] in '"\'' for _, op, literal in comparisons):
+            # Равенства одного ключа строковым литералам - суммы групп
+            groups = self._get_groups(steps, attr, key_attrs.pop())
+            return float(sum(groups.get(literal, 0.) for literal in
+                             {literal[1:-1] for _, _, literal in comparisons}))
+
+        mask = self._get_mask(steps, conjunction, comparisons)
+        return float(numbers[mask & present].sum())
@@ -0,0 +1,124 @@
+from typing import Any, Dict, Iterable, List, Tuple, Union
+# noinspection PyUnresolvedReferences
+from lxml import etree
+from .index import DocumentIndex
+from .interpreter import Interpreter
+from .xpath_interpreter import XPathInterpreter
+from .exceptions import ParserError
+
+
+class ErrorBatch:
+    """
+    Отложенное формирование текстов ошибок одной проверки файла.
+    Подстановки <usch:value-of select> вычисляются для всех ошибок сразу
+    при первом обращении к любому из текстов: ошибки группируются по контексту,
+    одинаковые подстановки в одном контексте вычисляются один раз.
+    FnsChecker по завершении проверки файла формирует только тексты ошибок,
+    оставшихся в результате (render(texts)), или не формирует их вовсе
+    (render_errors=False), после чего пакет освобождается (release).
+    """
+    def __init__(self, interpreter: Union[Interpreter, XPathInterpreter],
+                 document: Union[etree.ElementTree, DocumentIndex],
+                 filename: str) -> None:
+        self.interpreter = interpreter
+        self.document = document
+        self.filename = filename
+        # Тексты, ожидающие вычисления подстановок
+        self.pending: List['ErrorText'] = []
+        # (контекст, подстановка) -> значение, None - подстановка не вычислена
+        self.values: Dict[Tuple[str, str], Union[str, None]] = dict()
+
+    def add(self, context: str, error: Dict[str, Any]) -> 'ErrorText':
+        """ Текст ошибки проверки в контексте context. """
+        text = ErrorText(self, context, error)
+        self.pending.append(text)
+        return text
+
+    def render(self, texts: Iterable['ErrorText'] = None) -> None:
+        """
+        Вычисление подстановок текстов texts (по умолчанию всех ожидающих),
+        по одному проходу на контекст.
+        """
+        if texts is None:
+            texts, self.pending = self.pending, []
+        else:
+            # Тексты сравниваются по значению (__eq__), отбираются по id
+            selected = {id(text): text for text in texts if text.batch is self}
+            texts = list(selected.values())
+            self.pending = [text for text in self.pending if id(text) not in selected]
+
+        contexts: Dict[str, List[ErrorText]] = dict()
+        for text in texts:
+            contexts.setdefault(text.context, []).append(text)
+
+        for context, group in contexts.items():
+            for text in group:
+                for select, expr in text.error['replacing']:
+                    # Выражение не удалось разобрать при сборке компендиума
+                    if expr is None or (context, select) in self.values:
+                        continue
+                    try:
+                        value = str(self.interpreter.evaluate_expr(expr, self.document,
+                                                                   self.filename, context))
+                    except ParserError:
+                        # Подстановка остаётся в тексте без изменений
+                        value = None
+                    self.values[(context, select)] = value
+
+        for text in texts:
+            text.render(self.values)
+        if not self.pending:
+            # Документ больше не нужен, тексты сформированы
+            self.interpreter = self.document = None
+
+    def release(self) -> None:
+        """
+        Освобождение документа и интерпретатора. Оставшиеся тексты
+        не вычисляются и сохраняют подстановки шаблона без изменений.
+        """
+        pending, self.pending = self.pending, []
+        for text in pending:
+            text.render(dict())
+        self.interpreter = self.document = None
+
+
+class ErrorText:
+    """
+    Текст ошибки Schematron-выражения, формируется при первом обращении
+    (str, сравнение со строкой, сериализация pickle).
+    В результат проверки файла записывается str(ErrorText).
+    """
+    def __init__(self, batch: ErrorBatch, context: str, error: Dict[str, Any]) -> None:
+        self.batch = batch
+        self.context = context
+        self.error = error
+        self._text: str = None
+
+    def render(self, values: Dict[Tuple[str, str], Union[str, None]]) -> None:
+        text = self.error['text']
+        for select, _ in self.error['replacing']:
+            value = values.get((self.context, select))
+            if value is not None:
+                text = text.replace(select, value)
+        self._text = text
+        self.batch = None
+
+    def __str__(self) -> str:
+        if self._text is None:
+            self.batch.render()
+        return self._text
+
+    def __repr__(self) -> str:
+        return repr(str(self))
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (str, ErrorText)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(str(self))
+
+    def __reduce__(self) -> Tuple[type, Tuple[str]]:
+        # Между процессами (batch.check_files) передаётся готовый текст
+        return str, (str(self),)
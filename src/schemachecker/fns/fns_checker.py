@@ -1,34 +1,122 @@
 import os
-from typing import Dict, Any, ClassVar, Union, Tuple
+from itertools import islice
+from threading import Event, RLock, Thread
+from typing import Dict, Any, ClassVar, Union, Tuple, List, Iterable
 # noinspection PyUnresolvedReferences
 from lxml import etree
 from .interpreter import Interpreter
+from .xpath_interpreter import XPathInterpreter
 from .tokenizer import Tokenizer
+from .utils import LRUCache
+from .index import DocumentIndex, ProjectedIndex
+from .projection import Projection
+from .scheme_index import SchemeIndex
+from .subexpressions import SubexpressionTable
+from .error_text import ErrorBatch, ErrorText
 from .exceptions import *
+from ..snapshot import Snapshot
+from ..context import CheckContext, STREAM_THRESHOLD
+from ..xsd import XsdScheme
+
+
+class FnsContext(CheckContext):
+    """ Состояние проверки файла ФНС. """
+    def __init__(self, file: ClassVar[Dict[str, Any]],
+                 interpreter: Union[Interpreter, XPathInterpreter],
+                 stream_threshold: Union[int, None] = None,
+                 max_errors: Union[int, None] = None) -> None:
+        super().__init__(file, stream_threshold, max_errors)
+        self.xsd_content: etree.ElementTree = None
+        self.xsd_scheme: XsdScheme = None
+        # План проверок Schematron-выражений для файла
+        self.rules: List[Dict[str, Any]] = []
+        # Проекция документа для плана проверок и её индекс,
+        # строится вместо полного дерева при потоковой проверке
+        self.projection: Projection = None
+        self.index: ProjectedIndex = None
+        # Интерпретатор хранит индекс и кэш документа, свой для каждой проверки
+        self.interpreter = interpreter
+        # Отмена проверки выражений при ошибке XSD (режим fail_fast)
+        self.cancelled = Event()
+        # Тексты ошибок выражений, формируются по завершении проверки файла
+        self.error_texts: ErrorBatch = None
+
+    @property
+    def document(self) -> Union[etree.ElementTree, ProjectedIndex]:
+        """ Документ для вычисления выражений: индекс проекции или полное дерево. """
+        if self.index is not None:
+            return self.index
+        return self.xml_content
 
 
 class FnsChecker:
-    def __init__(self, *, root: str) -> None:
+    # Допустимые способы вычисления выражений и порядки проверок (см. __init__)
+    engines = ('stack', 'xpath')
+    modes = ('sequential', 'full', 'fail_fast')
+
+    def __init__(self, *, root: str,
+                 scheme_budget: int = 256 * 1024 * 1024,
+                 engine: str = 'stack',
+                 stream_threshold: Union[int, None] = STREAM_THRESHOLD,
+                 packrat: bool = False,
+                 mode: str = 'sequential',
+                 max_errors: Union[int, None] = None,
+                 render_errors: bool = True) -> None:
+        if engine not in self.engines:
+            raise ValueError(f'Неизвестный способ вычисления выражений {engine!r}, допустимые: {self.engines}')
+        if mode not in self.modes:
+            raise ValueError(f'Неизвестный порядок проверок {mode!r}, допустимые: {self.modes}')
+
         self.root = root
         # Корневая директория для файлов валидации
         self.xsd_root = os.path.join(root, 'compendium/fns/compendium/')
         # Файл компендиума с информацией о проверочных схемах
         self.comp_file = 'astral_formatCompendium.xml'
         self.compendium = dict()
-
-        self.filename = None
-        self.xml_content = None
-        self.xsd_content: etree.ElementTree = None
-        self.xsd_scheme: etree.XMLSchema = None
+        # Кэш скомпилированных XSD схем по ключу (КНД, версия).
+        # Бюджет памяти задаётся в байтах, вес схемы оценивается по размеру XSD файла
+        self.schemes = LRUCache(scheme_budget)
+        # Блокировка ленивой загрузки версий и кэша схем при параллельных проверках
+        self._lock = RLock()
 
         self.charset = 'cp1251'
         self.parser = etree.XMLParser(encoding=self.charset,
                                       recover=True,
                                       remove_comments=True)
 
-        # Подготовка лексера и интерпретатора
-        self.tokenizer = Tokenizer().create_tokenizer()
-        self.interpreter = Interpreter()
+        # Подготовка лексера и интерпретатора.
+        # engine - способ вычисления выражений:
+        #   stack - интерпретатор токенизированных выражений;
+        #   xpath - выражения компилируются в etree.XPath и вычисляются libxml2
+        # Грамматика лексера общая для процесса, packrat включает мемоизацию pyparsing
+        self.engine = engine
+        self.tokenizer = Tokenizer(packrat)
+        self.sch_expr = self.tokenizer.create_tokenizer()
+        self.interpreter = self._create_interpreter()
+
+        # Размер файла, начиная с которого XSD проверка выполняется потоково.
+        # None - файлы всегда проверяются по полному дереву
+        self.stream_threshold = stream_threshold
+
+        # Порядок проверки по XSD и проверки выражений fns:
+        #   sequential - выражения проверяются только после успешной XSD проверки;
+        #   full - проверки выполняются одновременно, XSD в отдельном потоке,
+        #          в результат попадают ошибки обеих проверок;
+        #   fail_fast - проверки выполняются одновременно, ошибка XSD прерывает
+        #               проверку выражений, результат как в режиме sequential
+        self.mode = mode
+        # Лимит числа ошибок в результате проверки файла, None - без ограничения
+        self.max_errors = max_errors
+        # Вычисление подстановок <usch:value-of> в текстах ошибок выражений.
+        # False - в результат записываются шаблоны текстов без подстановок,
+        # для проверок, которым нужен только вердикт и число ошибок
+        self.render_errors = render_errors
+
+    def _create_interpreter(self) -> Union[Interpreter, XPathInterpreter]:
+        """ Создание интерпретатора выбранного типа. """
+        if self.engine == 'xpath':
+            return XPathInterpreter()
+        return Interpreter()
 
     @staticmethod
     def _get_error(node: etree.Element) -> Dict[str, Any]:
@@ -70,28 +158,41 @@ class FnsChecker:
                 'inspection_items': []
             })
 
-    def _get_error_text(self, assertion: Dict[str, Any]) -> str:
-        error = assertion['error']
-        error_text = error['text']
-        for replacement in error['replacing']:
-            error_text = error_text.replace(
-                replacement, str(
-                    self.interpreter.evaluate_expr(replacement,
-                                                   self.xml_content,
-                                                   self.filename,
-                                                   assertion['context'])
-                )
-            )
-        return error_text
-
-    # TODO: вынести в создание компендиума
-    def _get_asserts(self, content: etree.ElementTree) -> List[Dict[str, Any]]:
-        """ Получение списка проверок Schematron-выражений. """
-        assertions = content.findall('.//xs:appinfo', namespaces=content.nsmap)
-        assert_list = []
+    def _compile_expr(self, expr: str, result_type: str = 'boolean') -> Union[List[str], etree.XPath, None]:
+        """
+        Подготовка выражения для выбранного интерпретатора при сборке компендиума:
+        токенизация или компиляция в etree.XPath. None - выражение не разобрано.
+        """
+        try:
+            if self.engine == 'xpath':
+                return self.interpreter.compile(expr, result_type)
+            return self.tokenizer.tokenize_expression(expr, self.sch_expr)
+        except Exception:
+            return None
+
+    def _compile_error(self, node: etree.Element) -> Dict[str, Any]:
+        """ Подготовка шаблона текста ошибки с токенизированными подстановками. """
+        error = self._get_error(node)
+        error['replacing'] = [(select, self._compile_expr(select, 'string'))
+                              for select in error['replacing']]
+        return error
+
+    def _compile_asserts(self, content: etree.ElementTree) -> List[Dict[str, Any]]:
+        """
+        Формирование плана проверок Schematron-выражений при сборке компендиума.
+        Все обращения к XSD схеме выполняются здесь, при проверке файла
+        используется только готовый план.
+        """
+        scheme_index = SchemeIndex.from_scheme(content)
+        rule_list = []
+
+        for appinfo in scheme_index.appinfos:
+            # Пропуск проверок, родительский элемент
+            # которых может не встречаться, minOccurs=0
+            if appinfo.optional:
+                continue
 
-        for assertion in assertions:
-            for pattern in assertion:
+            for pattern in appinfo.node:
                 name = pattern.attrib.get('name', None)
                 if not name:
                     continue
@@ -99,88 +200,125 @@ class FnsChecker:
                 for rule in pattern:
                     context = rule.attrib['context']
 
-                    # Пропуск проверок, родительский элемент
-                    # которых может не встречаться, minOccurs=0
-                    occurs_elements = assertion.xpath(
-                        f'ancestor::*[@minOccurs=0]')
-                    if len(occurs_elements):
-                        continue
-
-                    # Проверка, присутствует ли контекст в xml файле
-                    if len(self.xml_content.xpath(f'//{context}')) == 0:
-                        # Не найден контекст в xml файле
-
-                        # Пропуск опциональных проверок, choice
-                        choice_elements = assertion.xpath(f'ancestor::xs:choice',
-                                                          namespaces=content.nsmap)
-                        if len(choice_elements):
-                            # Опциональная проверка, пропускаем
-                            continue
-
-                        # Пропуск опциональных проверок, minOccurs="0"
-                        is_optional = True
-                        min_occurs = content.xpath(f'//xs:element[@name="{context}"]/@minOccurs',
-                                                   namespaces=content.nsmap)
-                        for occur_attrib in min_occurs:
-                            # Ошибка, проверка обязательна, контекст не найден
-                            if occur_attrib != '0':
-                                is_optional = False
-                                break
-
-                        # Ошибка, проверка обязательна, контекст не найден
-                        if not is_optional:
-                            raise ContextError(context, self.filename)
-
+                    assert_list = []
                     for sch_assert in rule:
                         for error_node in sch_assert:
-                            error = self._get_error(error_node)
-
                             assert_list.append({
-                                'name':     name,
                                 'assert':   sch_assert.attrib['test'],
-                                'context':  context,
-                                'error': error
+                                'expr':     self._compile_expr(sch_assert.attrib['test']),
+                                'error':    self._compile_error(error_node)
                             })
 
+                    rule_list.append({
+                        'name':     name,
+                        'context':  context,
+                        # Опциональные проверки, choice и minOccurs="0"
+                        'choice':   appinfo.choice,
+                        'optional': scheme_index.is_optional(context),
+                        'asserts':  assert_list
+                    })
+
+        return rule_list
+
+    @staticmethod
+    def _has_context(ctx: FnsContext, context: str) -> bool:
+        """ Проверка наличия контекста в документе. """
+        if ctx.index is not None:
+            return ctx.index.count(DocumentIndex.split_path(context)[0]) > 0
+        return len(ctx.xml_content.xpath(f'//{context}')) > 0
+
+    def _get_asserts(self, ctx: FnsContext) -> List[Dict[str, Any]]:
+        """ Получение списка проверок Schematron-выражений из плана для текущего файла. """
+        assert_list = []
+
+        for rule in ctx.rules:
+            context = rule['context']
+
+            # Проверка, присутствует ли контекст в xml файле
+            if not self._has_context(ctx, context):
+                # Не найден контекст в xml файле, пропускаем опциональные проверки
+                if rule['choice'] or rule['optional']:
+                    continue
+
+                # Ошибка, проверка обязательна, контекст не найден
+                raise ContextError(context, ctx.filename)
+
+            for assertion in rule['asserts']:
+                assert_list.append({
+                    'name':     rule['name'],
+                    'context':  context,
+                    **assertion
+                })
+
         return assert_list
 
-    def _set_scheme(self, file: ClassVar[Dict[str, Any]]) -> None:
+    def _get_compiled_scheme(self, knd: str, version: str,
+                             xsd_content: etree.ElementTree) -> XsdScheme:
+        """ Метод возвращает скомпилированную XSD схему, компилируя её при первом обращении. """
+        with self._lock:
+            xsd_scheme = self.schemes.get((knd, version))
+            if xsd_scheme is None:
+                xsd_scheme = XsdScheme(xsd_content)
+                self.schemes.put((knd, version), xsd_scheme,
+                                 weight=len(etree.tostring(xsd_content)))
+
+        return xsd_scheme
+
+    def _set_scheme(self, ctx: FnsContext) -> None:
         """ Метод для установки XSD схемы. """
         try:
-            file_info = file.get_result()['add_info']
+            file_info = ctx.file.get_result()['add_info']
             knd = file_info['knd']
             version = file_info['version']
         except AttributeError:
             raise FileAttributeError()
 
         comp_info = self.get_compendium_info(knd, version)
-        self.xsd_content = comp_info['xsd_scheme']
-        self.xsd_scheme = etree.XMLSchema(self.xsd_content)
+        ctx.xsd_content = comp_info['xsd_scheme']
+        ctx.xsd_scheme = self._get_compiled_scheme(knd, version, ctx.xsd_content)
+        ctx.rules = comp_info['rules']
+        ctx.projection = comp_info['projection']
 
-    def _validate_xsd(self, file: ClassVar[Dict[str, Any]]) -> bool:
-        ret_list = []
+    @staticmethod
+    def _run_xsd(ctx: FnsContext) -> Union[etree.DocumentInvalid, None]:
+        """ Проверка по XSD без записи результата. Возвращает ошибку валидации, None - файл корректен. """
         try:
-            self.xsd_scheme.assertValid(self.xml_content)
-            return True
+            ctx.assert_valid(ctx.xsd_scheme)
         except etree.DocumentInvalid as ex:
-            for error in self.xsd_scheme.error_log:
-                ret_list.append((str(error.line), error.message))
+            return ex
+        return None
 
-            self._set_error_struct(ret_list, file)
+    def _set_xsd_errors(self, ctx: FnsContext, ex: etree.DocumentInvalid) -> None:
+        """ Запись ошибок XSD проверки в результат. """
+        file = ctx.file
+        ret_list = []
+        # Сверх лимита достаточно одной ошибки, чтобы отметить усечение
+        error_log = ex.error_log if ctx.errors_left is None else islice(ex.error_log, ctx.errors_left + 1)
+        for error in error_log:
+            ret_list.append((str(error.line), error.message))
 
-            file.verify_result['result'] = 'failed_xsd'
-            file.verify_result['description'] = (
-                f'Ошибка при валидации по xsd схеме файла '
-                f'{self.filename}: {ex}.')
-            return False
+        self._set_error_struct(ctx.limit_errors(ret_list), file)
+
+        file.verify_result['result'] = 'failed_xsd'
+        file.verify_result['description'] = (
+            f'Ошибка при валидации по xsd схеме файла '
+            f'{ctx.filename}: {ex}.')
+
+    def _validate_xsd(self, ctx: FnsContext) -> bool:
+        invalid = self._run_xsd(ctx)
+        if invalid is None:
+            return True
+        self._set_xsd_errors(ctx, invalid)
+        return False
 
-    def _validate_schematron(self, file: ClassVar[Dict[str, Any]]) -> None:
+    def _validate_schematron(self, ctx: FnsContext) -> None:
+        file = ctx.file
         try:
-            asserts = self._get_asserts(self.xsd_content)
+            asserts = self._get_asserts(ctx)
         except InternalFnsError as ex:
             file.verify_result['result'] = 'failed_sch'
             file.verify_result['description'] = str(ex)
-            self._set_error_struct([('', str(ex))], file)
+            self._set_error_struct(ctx.limit_errors([('', str(ex))]), file)
             return
         except Exception as ex:
             file.verify_result['result'] = 'failed_sch'
@@ -192,14 +330,28 @@ class FnsChecker:
             return
 
         ret_list = []
+        # Тексты ошибок формируются после проверки файла (_render_errors)
+        ctx.error_texts = ErrorBatch(ctx.interpreter, ctx.document, ctx.filename)
+        # Есть ошибки сверх лимита
+        more = False
         for assertion in asserts:
+            # XSD проверка завершилась ошибкой, результат выражений не нужен
+            if ctx.cancelled.is_set():
+                return
+            # Выражение не удалось разобрать при сборке компендиума
+            if assertion['expr'] is None:
+                continue
             try:
-                assertion_result = self.interpreter.evaluate_expr(assertion['assert'],
-                                                                  self.xml_content,
-                                                                  self.filename,
-                                                                  assertion['context'])
+                assertion_result = ctx.interpreter.evaluate_expr(assertion['expr'],
+                                                                 ctx.document,
+                                                                 ctx.filename,
+                                                                 assertion['context'],
+                                                                 assertion.get('shared'))
                 if not assertion_result:
-                    ret_list.append((assertion['name'], self._get_error_text(assertion)))
+                    if ctx.errors_left is not None and len(ret_list) >= ctx.errors_left:
+                        more = True
+                        break
+                    ret_list.append((assertion['name'], ctx.error_texts.add(assertion['context'], assertion['error'])))
             except ParserError:
                 # FIXME (ParserError)
                 pass
@@ -208,10 +360,10 @@ class FnsChecker:
                 file.verify_result['description'] = ex
                 return
 
-        if len(ret_list):
+        if len(ret_list) or more:
             file.verify_result['result'] = 'failed_sch'
             file.verify_result['description'] = 'Ошибки при проверке fns'
-            self._set_error_struct(ret_list, file)
+            self._set_error_struct(ctx.limit_errors(ret_list, more), file)
 
     def _get_comp_file(self) -> etree.ElementTree:
         """
@@ -225,9 +377,15 @@ class FnsChecker:
         except (IOError, Exception) as ex:
             raise CompendiumParseError(self.comp_file, ex)
 
-    def _get_xsd_scheme(self, xsd_name: str) -> etree.ElementTree:
-        """ Метод возвращает проверочную схему в виде etree.ElementTree. """
+    def _get_xsd_scheme(self, xsd_name: str, xsd_bytes: bytes = None) -> etree.ElementTree:
+        """
+        Метод возвращает проверочную схему в виде etree.ElementTree.
+        xsd_bytes - содержимое схемы из снимка компендиума, файл схемы не читается.
+        """
         try:
+            if xsd_bytes is not None:
+                return etree.fromstring(xsd_bytes, self.parser,
+                                        base_url=os.path.join(self.xsd_root, xsd_name))
             with open(os.path.join(self.xsd_root, xsd_name), 'r', encoding=self.charset) as file:
                 xsd_schema = etree.parse(file, self.parser).getroot()
                 return xsd_schema
@@ -236,20 +394,27 @@ class FnsChecker:
             pass
 
     def _get_versions(self, format_node: etree.ElementTree) -> Dict[str, Dict[str, Any]]:
-        """ Метод формирует словарь версий для заданного КНД. """
+        """
+        Метод формирует словарь версий для заданного КНД.
+        Сохраняются только метаданные версии, XSD схема разбирается
+        при первом обращении в _load_version.
+        """
         version_dict = dict()
         for subformat in format_node:
             if subformat.get('XSD'):
                 version = subformat.text
                 xsd_name = subformat.get('XSD')
-                xsd_scheme = self._get_xsd_scheme(xsd_name)
                 date_from = subformat.get('dateFrom')
                 date_till = subformat.get('dateTill')
                 info_format = subformat.get('infoFormat')
 
                 version_dict.update({version: {
                     'xsd_name':     xsd_name,
-                    'xsd_scheme':   xsd_scheme,
+                    'xsd_scheme':   None,
+                    'rules':        None,
+                    'projection':   None,
+                    'subexpressions': None,
+                    'loaded':       False,
                     'date_from':    date_from,
                     'date_till':    date_till,
                     'info_format':  info_format
@@ -257,30 +422,91 @@ class FnsChecker:
 
         return version_dict
 
-    def _check_filename(self) -> Tuple[bool, str]:
+    def _load_version(self, version_node: Dict[str, Any]) -> None:
+        """ Разбор XSD схемы версии и сборка плана проверок при первом обращении. """
+        if version_node['loaded']:
+            return
+
+        with self._lock:
+            # Версию мог загрузить другой поток, пока ждали блокировку
+            if version_node['loaded']:
+                return
+
+            xsd_scheme = self._get_xsd_scheme(version_node['xsd_name'],
+                                              version_node.pop('xsd_bytes', None))
+            version_node['xsd_scheme'] = xsd_scheme
+            # План проверок может быть восстановлен из снимка компендиума
+            if version_node['rules'] is None:
+                version_node['rules'] = self._compile_asserts(xsd_scheme) if xsd_scheme is not None else []
+            # Проекция документа и общие подвыражения плана вычисляются
+            # только интерпретатором токенизированных выражений
+            if self.engine == 'stack':
+                version_node['projection'] = Projection.from_rules(version_node['rules'], self.interpreter)
+                version_node['subexpressions'] = SubexpressionTable.from_rules(version_node['rules'],
+                                                                               self.interpreter)
+            version_node['loaded'] = True
+
+    def _dump_compendium(self) -> Dict[str, Any]:
+        """
+        Подготовка компендиума к записи в снимок: загружаются все версии,
+        разобранные XSD схемы заменяются их содержимым. Планы проверок
+        сохраняются только для интерпретатора токенизированных выражений,
+        скомпилированные etree.XPath не сериализуются.
+        """
+        compendium = dict()
+        for knd, knd_node in self.compendium.items():
+            versions = dict()
+            for version, version_node in knd_node['versions'].items():
+                self._load_version(version_node)
+                xsd_scheme = version_node['xsd_scheme']
+                versions[version] = {
+                    **version_node,
+                    'xsd_scheme':   None,
+                    'xsd_bytes':    etree.tostring(xsd_scheme) if xsd_scheme is not None else None,
+                    'rules':        version_node['rules'] if self.engine == 'stack' else None,
+                    'projection':   None,
+                    'subexpressions': None,
+                    'loaded':       False
+                }
+            compendium[knd] = {**knd_node, 'versions': versions}
+
+        return compendium
+
+    @staticmethod
+    def _check_filename(ctx: FnsContext) -> Tuple[bool, str]:
         """ Метод проверяет соответствие имени файла и атрибута ИдФайл. """
-        filename = os.path.splitext(self.filename)[0]
-        attr_filename = self.xml_content.attrib['ИдФайл']
+        filename = os.path.splitext(ctx.filename)[0]
+        attr_filename = ctx.head().attrib['ИдФайл']
         return filename == attr_filename, attr_filename
 
-    def _mandatory_verification(self, file: ClassVar[Dict[str, Any]]) -> bool:
+    def _mandatory_verification(self, ctx: FnsContext) -> bool:
         """ Метод реализует обязательные проверки, например, проверку соответствия имени файла. """
-        correct_filename, attr_filename = self._check_filename()
+        file = ctx.file
+        correct_filename, attr_filename = self._check_filename(ctx)
         if not correct_filename:
-            ret_list = [('', f'Имя файла обмена {self.filename} не совпадает со значением '
+            ret_list = [('', f'Имя файла обмена {ctx.filename} не совпадает со значением '
                              f'атрибута ИдФайл {attr_filename}')]
-            self._set_error_struct(ret_list, file)
+            self._set_error_struct(ctx.limit_errors(ret_list), file)
 
             file.verify_result['result'] = 'failed_ver'
             file.verify_result['description'] = (
-                f'Ошибка при проведении обязательных проверок {self.filename}')
+                f'Ошибка при проведении обязательных проверок {ctx.filename}')
             return False
 
         return True
 
-    def setup_compendium(self) -> None:
+    def setup_compendium(self, preload: Iterable[str] = (), snapshot: str = None) -> None:
         """
         Сборка компендиума в памяти.
+        При сборке читаются только метаданные форматов, XSD схемы разбираются,
+        а планы проверок собираются при первом обращении к версии формата.
+        preload - список КНД, схемы всех версий которых загружаются сразу.
+        snapshot - путь к снимку компендиума. Действующий снимок загружается
+        вместо сборки, иначе компендиум собирается полностью (все версии)
+        и записывается в снимок. XSD схемы из снимка хранятся в виде содержимого
+        файла ('xsd_bytes') до первого обращения.
+        Скомпилированные XSD схемы (etree.XMLSchema) хранятся рядом с компендиумом
+        в LRU кэше self.schemes и создаются при первой проверке файла формата.
         Компендиум имеет следующую структуру:
         {
             '0710099': {  # КНД
@@ -289,7 +515,30 @@ class FnsChecker:
                 'versions': {  # Cловарь версий
                     '5.01': {  # Версия
                         'xsd_name': 'NO_BUHOTCH_1_105_00_05_01_01.xsd',
-                        'xsd_scheme': etree.ElementTree,
+                        'xsd_scheme': etree.ElementTree,  # None до первого обращения
+                        'rules': [  # План проверок Schematron-выражений
+                            {
+                                'name': str,  # Имя паттерна
+                                'context': str,  # Контекст правила
+                                'choice': bool,  # Правило внутри xs:choice
+                                'optional': bool,  # Контекст опционален, minOccurs="0"
+                                'asserts': [
+                                    {
+                                        'assert': str,  # Исходное выражение
+                                        'expr': Union[List[str], etree.XPath],  # Подготовленное выражение
+                                        'shared': SharedPlan,  # Разметка общих поддеревьев выражения
+                                        'error': {
+                                            'code': str,
+                                            'text': str,
+                                            'replacing': [(str, Union[List[str], etree.XPath])]
+                                        }
+                                    }
+                                ]
+                            }
+                        ],
+                        'projection': Projection,  # Проекция документа для плана, None - не строится
+                        'subexpressions': SubexpressionTable,  # Общие подвыражения плана
+                        'loaded': bool,  # Схема разобрана, план проверок собран
                         'date_from': '01.01.2016',
                         'date_till': '01.01.2019',
                         'info_format': ''
@@ -298,21 +547,42 @@ class FnsChecker:
             }
         }
         """
-        compendium = self._get_comp_file()
-        formats = compendium.xpath('//format[@direction="ФНС" or @direction=""]')
-
         self.compendium = dict()
-        for _format in formats:
-            if _format.get('obsolete') != 'true':
-                knd = _format.get('searchKey')
-                alias_short = _format.get('aliasShort')
-                alias_full = _format.get('aliasFull')
-                versions = self._get_versions(_format)
-                self.compendium.update({knd: {
-                    'alias_short':  alias_short,
-                    'alias_full':   alias_full,
-                    'versions':     versions
-                }})
+        self.schemes.clear()
+
+        if snapshot is not None:
+            snapshot = Snapshot(snapshot, self.xsd_root, key=self.engine)
+            self.compendium = snapshot.load() or dict()
+
+        if not self.compendium:
+            compendium = self._get_comp_file()
+            formats = compendium.xpath('//format[@direction="ФНС" or @direction=""]')
+
+            for _format in formats:
+                if _format.get('obsolete') != 'true':
+                    knd = _format.get('searchKey')
+                    alias_short = _format.get('aliasShort')
+                    alias_full = _format.get('aliasFull')
+                    versions = self._get_versions(_format)
+                    self.compendium.update({knd: {
+                        'alias_short':  alias_short,
+                        'alias_full':   alias_full,
+                        'versions':     versions
+                    }})
+
+            if snapshot is not None:
+                # Дальше работаем с содержимым снимка, как после его загрузки
+                self.compendium = self._dump_compendium()
+                snapshot.dump(self.compendium)
+
+        for knd in preload:
+            knd_node = self.compendium.get(knd)
+            if knd_node is None:
+                continue
+            for version, version_node in knd_node['versions'].items():
+                self._load_version(version_node)
+                if version_node['xsd_scheme'] is not None:
+                    self._get_compiled_scheme(knd, version, version_node['xsd_scheme'])
 
     def get_compendium_info(self, knd: str, version: str) -> Dict[str, Any]:
         """ Метод получения информации по КНД и версии из компендиума в памяти. """
@@ -323,29 +593,137 @@ class FnsChecker:
                        'alias_full': knd_node['alias_full']})
 
             version_node = knd_node['versions'].get(version)
+            self._load_version(version_node)
             res.update(**version_node)
             return res
         except (AttributeError, TypeError):
             raise SchemeNotFound(knd, version)
 
+    def get_duplication_report(self, knd: str = None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        Отчёт о дублировании подвыражений в планах проверок загруженных версий
+        (SubexpressionTable.report) по КНД и версии. knd - отчёт только по одному КНД.
+        """
+        report = dict()
+        for knd_key, knd_node in self.compendium.items():
+            if knd is not None and knd_key != knd:
+                continue
+            for version, version_node in knd_node['versions'].items():
+                table = version_node.get('subexpressions')
+                if table is not None:
+                    report.setdefault(knd_key, dict())[version] = table.report()
+        return report
+
     def check_file(self, file: ClassVar[Dict[str, Any]]) -> None:
-        self.filename = file.filename
-        self.xml_content = file.xml_tree
+        """
+        Проверка файла. Состояние проверки хранится в FnsContext,
+        метод можно вызывать одновременно из нескольких потоков.
+        """
+        ctx = FnsContext(file, self._create_interpreter(), self.stream_threshold, self.max_errors)
 
         file.verify_result = dict()
 
         file.verify_result['result'] = 'passed'
         file.verify_result['asserts'] = []
 
-        self._set_scheme(file)
+        self._set_scheme(ctx)
 
-        # Обязательные проверки
-        if not self._mandatory_verification(file):
-            return
+        try:
+            # Обязательные проверки
+            if not self._mandatory_verification(ctx):
+                return
+
+            if self.mode != 'sequential':
+                self._validate_concurrently(ctx)
+                return
+
+            # Проверка по xsd
+            if not self._validate_xsd(ctx):
+                return
+
+            self._evaluate_schematron(ctx)
+        finally:
+            self._render_errors(ctx)
+
+    def _render_errors(self, ctx: FnsContext) -> None:
+        """
+        Формирование текстов ошибок, попавших в результат проверки
+        (без подстановок, если render_errors выключен).
+        Результат содержит только строки (сериализуется в json),
+        документ и интерпретатор проверки не удерживаются после её завершения.
+        """
+        asserts = ctx.file.verify_result['asserts']
+        if ctx.error_texts is not None:
+            if self.render_errors:
+                # Тексты, не попавшие в результат (лимит, режим fail_fast), не формируются
+                ctx.error_texts.render([error['description'] for error in asserts
+                                        if isinstance(error['description'], ErrorText)])
+            ctx.error_texts.release()
+            ctx.error_texts = None
+        for error in asserts:
+            error['description'] = str(error['description'])
+
+    def _evaluate_schematron(self, ctx: FnsContext) -> None:
+        """
+        Проверка выражений fns. Для больших файлов вместо полного дерева
+        строится проекция документа, если её допускает план проверок.
+        """
+        if ctx.streaming and ctx.projection is not None:
+            source, options = ctx.get_source()
+            ctx.index = ctx.projection.build(source, **options)
+        self._validate_schematron(ctx)
+
+    def _validate_concurrently(self, ctx: FnsContext) -> None:
+        """
+        Проверка по XSD в отдельном потоке (lxml отпускает GIL при валидации)
+        одновременно с проверкой выражений fns. Поток XSD проверки только
+        валидирует документ, результат записывается после его завершения:
+        ошибки XSD ставятся перед ошибками выражений (режим full)
+        или заменяют их (режим fail_fast).
+        """
+        file = ctx.file
+        xsd_result = dict()
 
-        # Проверка по xsd
-        if not self._validate_xsd(file):
+        def _run_xsd() -> None:
+            try:
+                xsd_result['invalid'] = self._run_xsd(ctx)
+            except Exception as ex:
+                xsd_result['error'] = ex
+            if 'error' in xsd_result or (self.mode == 'fail_fast' and xsd_result['invalid'] is not None):
+                ctx.cancelled.set()
+
+        if not ctx.streaming:
+            # Дерево разбирается до запуска потока, обе проверки используют одно дерево
+            ctx.xml_content
+        thread = Thread(target=_run_xsd, daemon=True)
+        thread.start()
+        sch_error = None
+        try:
+            self._evaluate_schematron(ctx)
+        except Exception as ex:
+            sch_error = ex
+        finally:
+            thread.join()
+
+        if 'error' in xsd_result:
+            raise xsd_result['error']
+        invalid = xsd_result['invalid']
+        if invalid is None:
+            if sch_error is not None:
+                raise sch_error
             return
 
-        # Проверка выражений fns
-        self._validate_schematron(file)
+        # Ошибки выражений на невалидном документе сохраняются только в режиме full,
+        # лимит ошибок применяется к объединённому списку
+        sch_list = []
+        sch_truncated = False
+        if self.mode == 'full':
+            sch_list = [(error['error_code'], error['description']) for error in file.verify_result['asserts']]
+            sch_truncated = ctx.truncated
+            if sch_truncated:
+                # Маркер усечения ошибок выражений
+                sch_list = sch_list[:-1]
+        file.verify_result['asserts'] = []
+        ctx.reset_errors()
+        self._set_xsd_errors(ctx, invalid)
+        self._set_error_struct(ctx.limit_errors(sch_list, sch_truncated), file)
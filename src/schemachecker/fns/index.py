@@ -0,0 +1,131 @@
+from collections import defaultdict
+from heapq import merge
+from typing import Dict, List, Tuple, Union
+# noinspection PyUnresolvedReferences
+from lxml import etree
+
+# Символы, недопустимые в простом шаге пути (имени элемента)
+_complex_step = set('@*:.[]()= ')
+
+
+class DocumentIndex:
+    """
+    Индекс элементов документа, строится за один проход по дереву.
+    Каждому полному пути элемента (кортежу имён от корня) сопоставляется
+    список элементов в порядке документа. Поиск по выражению вида //a/b/@c
+    сводится к выбору путей, оканчивающихся на (a, b), без повторного
+    обхода документа.
+    """
+    def __init__(self) -> None:
+        # Полный путь -> порядковые номера элементов в документе
+        self.ordinals: Dict[Tuple[str, ...], List[int]] = defaultdict(list)
+        # Полный путь -> элементы
+        self.elements: Dict[Tuple[str, ...], List[etree.Element]] = defaultdict(list)
+
+        # Кэш полных путей, оканчивающихся заданной последовательностью имён
+        self._suffixes: Dict[Tuple[str, ...], List[Tuple[str, ...]]] = dict()
+        # Кэш значений атрибутов: (полный путь, атрибут) -> список значений
+        self._columns: Dict[Tuple[Tuple[str, ...], str], List[Union[str, None]]] = dict()
+
+    @classmethod
+    def from_tree(cls, root: etree.ElementTree) -> 'DocumentIndex':
+        """ Построение индекса по дереву документа. """
+        index = cls()
+        path = []
+        ordinal = 0
+
+        for event, element in etree.iterwalk(root, events=('start', 'end'), tag=etree.Element):
+            if event == 'start':
+                path.append(element.tag)
+                full_path = tuple(path)
+                index.ordinals[full_path].append(ordinal)
+                index.elements[full_path].append(element)
+                ordinal += 1
+            else:
+                path.pop()
+
+        return index
+
+    @staticmethod
+    def split_path(path: str) -> Union[Tuple[Tuple[str, ...], Union[str, None]], None]:
+        """
+        Разбор пути вида a/b/@c на кортеж имён элементов и имя атрибута.
+        Возвращает None, если путь содержит конструкции сложнее простых шагов
+        (предикаты, оси, подстановки) и не может быть разрешён по индексу.
+        """
+        steps = [step.strip() for step in path.split('/')]
+        attr = None
+        if steps and steps[-1].startswith('@'):
+            attr = steps.pop()[1:]
+            if not attr or set(attr) & _complex_step:
+                return None
+
+        if not steps:
+            return None
+        for step in steps:
+            if not step or set(step) & _complex_step:
+                return None
+
+        return tuple(steps), attr
+
+    def _match(self, steps: Tuple[str, ...]) -> List[Tuple[str, ...]]:
+        """ Полные пути элементов, оканчивающиеся последовательностью имён steps. """
+        paths = self._suffixes.get(steps)
+        if paths is None:
+            size = len(steps)
+            paths = [path for path in self.ordinals if path[-size:] == steps]
+            self._suffixes[steps] = paths
+
+        return paths
+
+    def column(self, path: Tuple[str, ...], attr: str) -> List[Union[str, None]]:
+        """ Значения атрибута attr у элементов с полным путём path. """
+        column = self._columns.get((path, attr))
+        if column is None:
+            column = [element.get(attr) for element in self.elements[path]]
+            self._columns[(path, attr)] = column
+
+        return column
+
+    def find(self, steps: Tuple[str, ...]) -> List[etree.Element]:
+        """ Аналог //a/b: элементы в порядке документа. """
+        paths = self._match(steps)
+        if len(paths) == 1:
+            return self.elements[paths[0]]
+
+        ordered = merge(*(zip(self.ordinals[path], self.elements[path]) for path in paths),
+                        key=lambda item: item[0])
+        return [element for _, element in ordered]
+
+    def values(self, steps: Tuple[str, ...], attr: str) -> List[str]:
+        """ Аналог //a/b/@c: значения атрибута в порядке документа. """
+        paths = self._match(steps)
+        ordered = merge(*(zip(self.ordinals[path], self.column(path, attr)) for path in paths),
+                        key=lambda item: item[0])
+        return [value for _, value in ordered if value is not None]
+
+    def count(self, steps: Tuple[str, ...], attr: str = None) -> int:
+        """ Аналог count(//a/b) и count(//a/b/@c). """
+        paths = self._match(steps)
+        if attr is None:
+            return sum(len(self.ordinals[path]) for path in paths)
+
+        return sum(len(column) - column.count(None)
+                   for column in (self.column(path, attr) for path in paths))
+
+
+class ProjectedIndex(DocumentIndex):
+    """
+    Индекс проекции документа (см. projection.Projection).
+    Строится при потоковом разборе и хранит только пути, нужные плану
+    проверок: порядковые номера элементов и заранее собранные значения
+    атрибутов. Сами элементы не хранятся, find возвращает порядковые номера,
+    чего достаточно для проверки наличия элементов.
+    """
+    def find(self, steps: Tuple[str, ...]) -> List[int]:
+        """ Аналог //a/b: порядковые номера элементов в документе. """
+        return list(merge(*(self.ordinals[path] for path in self._match(steps))))
+
+    def column(self, path: Tuple[str, ...], attr: str) -> List[Union[str, None]]:
+        """ Значения атрибута attr у элементов с полным путём path, собранные при разборе. """
+        return self._columns[(path, attr)]
@@ -1,13 +1,41 @@
+import math
 import operator
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 from functools import wraps
-from copy import deepcopy
 from lxml import etree
+from .index import DocumentIndex
+from .columnar import ColumnStore
+from .utils import LRUCache
 from .exceptions import ParserError, TypeConvError, NodeAttributeError
 
 
+# Отсутствующее в кэше значение
+_missing = object()
+
+
+def _format_number(value: float) -> str:
+    """
+    Строковое значение числа, как string() в libxml2 (lxml): NaN, Infinity,
+    целые в пределах int без дробной части, остальные - 15 значащих цифр,
+    вне диапазона 1e-5..1e9 - в экспоненциальной записи.
+    """
+    if value != value:
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if value.is_integer() and -2 ** 31 < value < 2 ** 31 - 1:
+        return str(int(value))
+    absolute = abs(value)
+    if absolute > 1e9 or absolute < 1e-5:
+        mantissa, exponent = f'{value:.14e}'.split('e')
+        return f"{mantissa.rstrip('0').rstrip('.')}e{exponent}"
+    places = int(math.log10(absolute))
+    fraction = 14 - places if places > 0 else 15 - places
+    return f'{value:.{fraction}f}'.rstrip('0').rstrip('.')
+
+
 class Interpreter:
-    def __init__(self) -> None:
+    def __init__(self, cache_size: int = 65536) -> None:
         # Символы, которые могут содержаться в элементе узла
         self._alphabet = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
         self._nums = '1234567890'
@@ -52,24 +80,48 @@ class Interpreter:
             'concat': self._concat_func
         }
 
-        self.stack = []
+        # Логические операторы с сокращённым вычислением:
+        # значение левого операнда, при котором правый не вычисляется
+        self._short_circuit_map = {
+            'and': False,
+            'or': True
+        }
+
+        # Стек выражения не изменяется при вычислении,
+        # позиция вершины хранится в self.pos
+        self.stack = ()
+        self.pos = 0
+        # Разметка общих поддеревьев выражения (subexpressions.SharedPlan):
+        # начало поддерева и номер общего поддерева для каждой позиции стека
+        self.spans: Tuple[int, ...] = None
+        self.shared: Tuple[Union[int, None], ...] = None
 
         self.xml_content = None
         self.context = None
         self.xml_file = None
+        # Индекс элементов текущего документа
+        self.index: DocumentIndex = None
+        # Колонки атрибутов текущего документа для sum по всем узлам пути
+        self.columns: ColumnStore = None
+
+        # Кэш вычисленных узлов и функций, время жизни - документ.
+        # Статистика обращений доступна в self.cache.hits и self.cache.misses
+        self.cache_size = cache_size
+        self.cache = LRUCache(cache_size)
+        # Значения общих поддеревьев плана проверок по номеру, время жизни - документ
+        self.memo: Dict[int, Union[str, int, bool, float]] = dict()
 
-        self.cache = dict()
-
-    # TODO: LRU caching
     def _cached_node(func):
         # Кэшируется только один элемент - узел
         @wraps(func)
         def _inner(*args, **kwargs):
             self = args[0]
-            element = f'//{self.context}/{args[1]}'
-            if element not in self.cache:
-                self.cache[element] = func(*args, **kwargs)
-            return self.cache[element]
+            key = (self.context, args[1])
+            value = self.cache.get(key, _missing)
+            if value is _missing:
+                value = func(*args, **kwargs)
+                self.cache.put(key, value)
+            return value
 
         return _inner
 
@@ -79,17 +131,29 @@ class Interpreter:
             self = args[0]
             # Нужен контекст, могут быть идентичные сигнатуры
             # в разных контекстах
-            element = f'{func.__name__}/{self.context}/{args[1:]}'
-            if element not in self.cache:
-                self.cache[element] = func(*args, **kwargs)
-            return self.cache[element]
+            key = (func.__name__, self.context, args[1:])
+            value = self.cache.get(key, _missing)
+            if value is _missing:
+                value = func(*args, **kwargs)
+                self.cache.put(key, value)
+            return value
 
         return _inner
 
+    def _lookup(self, node) -> list:
+        """ Поиск узлов //context/node по индексу документа, при невозможности - через XPath. """
+        path = DocumentIndex.split_path(f'{self.context}/{node}')
+        if path is None:
+            return self.xml_content.xpath(f'//{self.context}/{node}')
+
+        steps, attr = path
+        if attr is None:
+            return self.index.find(steps)
+        return self.index.values(steps, attr)
+
     @_cached_node
     def _evaluate_node(self, node):
-        element = f'//{self.context}/{node}'
-        value = self.xml_content.xpath(element)
+        value = self._lookup(node)
         if '@' in node:
             # Работаем с атрибутом, возвращаем значение
             if not value:
@@ -102,14 +166,104 @@ class Interpreter:
             # Работаем с элементом, возвращаем наличие
             return True if value else False
 
-    def _evaluate_stack(self) -> Union[str, int, Exception]:
-        op = self.stack.pop()
+    def get_nodes(self, expr: List[str]) -> List[str]:
+        """ Узлы (пути относительно контекста), к которым обращается выражение. """
+        operators = (self._nullary_map.keys() | self._unary_map.keys() | self._binary_map.keys()
+                     | self._ternary_map.keys() | self._varargs_map.keys())
+        return [token for token in expr
+                if token not in operators and not token.isdigit() and not token.startswith('\'')]
+
+    def get_sum_nodes(self, expr: List[str]) -> List[str]:
+        """ Узлы, сумма значений которых вычисляется выражением (sum, см. _sum_nodes). """
+        return [expr[idx - 1] for idx, token in enumerate(expr)
+                if token == 'sum' and idx and set(expr[idx - 1]) <= self._element]
+
+    def _pop(self) -> str:
+        """ Снятие элемента с вершины стека сдвигом курсора. """
+        self.pos -= 1
+        return self.stack[self.pos]
+
+    def _is_node_arg(self) -> bool:
+        """ Проверка, является ли вершина стека аргументом-узлом функции concat. """
+        return self.pos > 0 and set(self.stack[self.pos - 1]) <= self._element
+
+    def _skip(self) -> None:
+        """ Пропуск поддерева на вершине стека без вычисления. """
+        op = self._pop()
 
         if op in self._nullary_map:
+            return
+        elif op in self._unary_map:
+            if op == 'count':
+                self.pos -= 1
+            else:
+                self._skip()
+        elif op in self._binary_map:
+            self._skip()
+            self._skip()
+        elif op in self._ternary_map:
+            self._skip()
+            if op == 'substring' and not self.stack[self.pos - 1].isdigit():
+                # substring без опционального третьего аргумента
+                self._skip()
+                return
+            self._skip()
+            self._skip()
+        elif op in self._varargs_map:
+            while self._is_node_arg():
+                self._skip()
+
+    def get_spans(self, expr: List[str]) -> List[int]:
+        """ Таблица границ: начало поддерева с вершиной в каждой позиции выражения. """
+        stack, pos = self.stack, self.pos
+        self.stack = expr
+        spans = []
+        try:
+            for end in range(1, len(expr) + 1):
+                self.pos = end
+                self._skip()
+                spans.append(self.pos)
+        finally:
+            self.stack, self.pos = stack, pos
+        return spans
+
+    def _evaluate_stack(self) -> Union[str, int, Exception]:
+        if self.shared is not None:
+            node_id = self.shared[self.pos - 1]
+            if node_id is not None:
+                # Общее поддерево плана вычисляется один раз для документа
+                start = self.spans[self.pos - 1]
+                value = self.memo.get(node_id, _missing)
+                if value is _missing:
+                    value = self.memo[node_id] = self._evaluate_op()
+                self.pos = start
+                return value
+        return self._evaluate_op()
+
+    def _evaluate_op(self) -> Union[str, int, Exception]:
+        op = self._pop()
+
+        if op in self._short_circuit_map:
+            # Правый операнд пропускаем и вычисляем только при необходимости,
+            # ошибки в невычисленной ветви не возникают
+            right = self.pos
+            self._skip()
+            arg1 = self._evaluate_stack()
+            if bool(arg1) == self._short_circuit_map[op]:
+                return bool(arg1)
+            left = self.pos
+            self.pos = right
+            arg2 = self._evaluate_stack()
+            self.pos = left
+            return self._binary_map[op](arg1, arg2)
+        elif op in self._nullary_map:
             return self._nullary_map[op]()
         elif op in self._unary_map:
             if op == 'count':
-                arg = self.stack.pop()
+                arg = self._pop()
+            elif op == 'sum' and self._is_node_arg():
+                # Сумма значений всех узлов пути, а не значение первого из них
+                return self._sum_nodes(self._pop())
             else:
                 arg = self._evaluate_stack()
             return self._unary_map[op](arg)
@@ -128,13 +282,9 @@ class Interpreter:
         elif op in self._varargs_map:
             args = []
             # Смотрим на вершину стека, если он не пуст
-            if len(self.stack):
-                arg = self.stack[-1]
-                while set(arg) <= self._element:
-                    # Если элемент узла - можно вычислять значение
-                    arg = self._evaluate_stack()
-                    args.append(arg)
-                    arg = self.stack[-1]
+            while self._is_node_arg():
+                # Если элемент узла - можно вычислять значение
+                args.append(self._evaluate_stack())
             # Разворачиваем аргументы, приходят из стека в обратном порядке
             return self._varargs_map[op](*args[::-1])
         elif op.isdigit():
@@ -186,8 +336,11 @@ class Interpreter:
 
     @_cached_func
     def _count_func(self, node):
-        return str(len(self.xml_content
-                       .xpath(f'//{self.context}/{node}')))
+        path = DocumentIndex.split_path(f'{self.context}/{node}')
+        if path is None:
+            return str(len(self.xml_content
+                           .xpath(f'//{self.context}/{node}')))
+        return str(self.index.count(*path))
 
     @_cached_func
     def _round_func(self, node):
@@ -197,6 +350,18 @@ class Interpreter:
     def _sum_func(self, node):
         return node
 
+    @_cached_func
+    def _sum_nodes(self, node):
+        """
+        Аналог string(sum(//context/node)): сумма вычисляется по колонкам
+        атрибутов (ColumnStore), для остальных путей - через XPath.
+        """
+        path = f'//{self.context}/{node.strip()}'
+        value = self.columns.sum(path)
+        if value is None:
+            value = self.xml_content.xpath(f'sum({path})')
+        return _format_number(value)
+
     @_cached_func
     def _number_func(self, node):
         return node
@@ -222,16 +387,29 @@ class Interpreter:
         return first_node == second_node
 
     def evaluate_expr(self, expr: List[str],
-                      xml_content: etree.ElementTree,
+                      xml_content: Union[etree.ElementTree, DocumentIndex],
                       xml_file: str,
-                      context: str) -> Union[Exception]:
-        # Очитка кэша
-        self.cache = dict()
+                      context: str,
+                      shared: Tuple[Tuple[int, ...], Tuple[Union[int, None], ...]] = None) -> Union[Exception]:
+        # Новый документ, строим индекс элементов за один проход
+        # и очищаем кэш вместе со статистикой обращений.
+        # Проекция документа (projection.Projection) передаётся готовым индексом.
+        # shared - разметка общих поддеревьев плана проверок (subexpressions.SharedPlan)
+        if xml_content is not self.xml_content:
+            if isinstance(xml_content, DocumentIndex):
+                self.index = xml_content
+            else:
+                self.index = DocumentIndex.from_tree(xml_content)
+            self.columns = ColumnStore(self.index)
+            self.cache = LRUCache(self.cache_size)
+            self.memo = dict()
 
         self.xml_content = xml_content
         self.xml_file = xml_file
         self.context = context
-        self.stack = deepcopy(expr)
+        self.stack = expr
+        self.pos = len(expr)
+        self.spans, self.shared = shared or (None, None)
 
         try:
             return self._evaluate_stack()
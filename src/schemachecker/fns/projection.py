@@ -0,0 +1,108 @@
+from typing import Any, Dict, IO, List, Set, Tuple, Union
+# noinspection PyUnresolvedReferences
+from lxml import etree
+from .index import DocumentIndex, ProjectedIndex
+from .interpreter import Interpreter
+from .columnar import ColumnStore
+
+
+class Projection:
+    """
+    Проекция документа для плана проверок формата.
+    По токенизированным выражениям плана определяются пути элементов
+    и атрибутов, к которым обращается интерпретатор (//context/node).
+    При потоковом разборе файла сохраняются только значения по этим путям,
+    остальные элементы сразу удаляются из памяти.
+    Проекция строится, только если все пути плана разрешаются по индексу
+    документа (простые шаги без предикатов и осей), а суммы sum()
+    вычисляются по колонкам атрибутов (ColumnStore), иначе нужен XPath
+    по полному дереву.
+    """
+    def __init__(self) -> None:
+        # Окончание полного пути элемента -> нужные атрибуты
+        self.paths: Dict[Tuple[str, ...], Set[str]] = dict()
+
+    @classmethod
+    def from_rules(cls, rules: List[Dict[str, Any]],
+                   interpreter: Interpreter) -> Union['Projection', None]:
+        """ Проекция по плану проверок. None - план требует полного дерева. """
+        projection = cls()
+
+        for rule in rules:
+            context = rule['context']
+            if not projection._add(context):
+                return None
+
+            for assertion in rule['asserts']:
+                exprs = [assertion['expr'], *(expr for _, expr in assertion['error']['replacing'])]
+                for expr in exprs:
+                    # Выражение не удалось разобрать при сборке компендиума
+                    if expr is None:
+                        continue
+                    for node in interpreter.get_nodes(expr):
+                        if not projection._add(f'{context}/{node}'):
+                            return None
+                    # Сумма значений элементов вычисляется только XPath по дереву
+                    for node in interpreter.get_sum_nodes(expr):
+                        if not ColumnStore.supports(f'//{context}/{node}'):
+                            return None
+
+        return projection
+
+    def _add(self, path: str) -> bool:
+        """ Добавление пути в проекцию. False - путь не разрешается по индексу. """
+        path = DocumentIndex.split_path(path)
+        if path is None:
+            return False
+
+        steps, attr = path
+        attrs = self.paths.setdefault(steps, set())
+        if attr is not None:
+            attrs.add(attr)
+        return True
+
+    def _get_attrs(self, full_path: Tuple[str, ...]) -> Union[Set[str], None]:
+        """ Атрибуты, нужные элементу с полным путём full_path. None - элемент не нужен. """
+        attrs = None
+        for steps, steps_attrs in self.paths.items():
+            if full_path[-len(steps):] == steps:
+                attrs = (attrs or set()) | steps_attrs
+        return attrs
+
+    def build(self, source: Union[str, IO], **options) -> ProjectedIndex:
+        """
+        Построение индекса проекции за один потоковый проход по документу.
+        :param source: путь к файлу или файловый объект.
+        :param options: параметры разбора etree.iterparse (например, encoding).
+        """
+        index = ProjectedIndex()
+        # Полный путь -> нужные атрибуты, вычисляется один раз для каждого пути
+        matched: Dict[Tuple[str, ...], Union[Set[str], None]] = dict()
+        path = []
+        ordinal = 0
+
+        for event, element in etree.iterparse(source, events=('start', 'end'),
+                                              remove_comments=True, huge_tree=True,
+                                              **options):
+            if event == 'start':
+                path.append(element.tag)
+                full_path = tuple(path)
+                if full_path not in matched:
+                    matched[full_path] = self._get_attrs(full_path)
+                    for attr in matched[full_path] or ():
+                        index._columns[(full_path, attr)] = []
+
+                attrs = matched[full_path]
+                if attrs is not None:
+                    index.ordinals[full_path].append(ordinal)
+                    for attr in attrs:
+                        index._columns[(full_path, attr)].append(element.get(attr))
+                ordinal += 1
+            else:
+                path.pop()
+                element.clear()
+                # Удаляем обработанные соседние элементы, оставшиеся у родителя
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+        return index
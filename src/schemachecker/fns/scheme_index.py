@@ -0,0 +1,69 @@
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Union
+# noinspection PyUnresolvedReferences
+from lxml import etree
+
+
+class AppInfo(NamedTuple):
+    """ Блок xs:appinfo с Schematron-правилами и его положение в схеме. """
+    node: etree.Element
+    # Есть предок с minOccurs=0, правила блока не проверяются
+    optional: bool
+    # Блок находится внутри xs:choice
+    choice: bool
+
+
+def _is_zero(value: Union[str, None]) -> bool:
+    """ Аналог предиката XPath [@minOccurs=0] (сравнение чисел). """
+    try:
+        return float(value) == 0
+    except (TypeError, ValueError):
+        return False
+
+
+class SchemeIndex:
+    """
+    Индекс опциональности элементов XSD схемы, строится за один проход.
+    Заменяет запросы ancestor::*[@minOccurs=0], ancestor::xs:choice
+    для каждого блока xs:appinfo и //xs:element[@name=...]/@minOccurs
+    (просмотр всей схемы) для каждого правила поиском в словаре.
+    """
+    def __init__(self) -> None:
+        # Блоки xs:appinfo в порядке схемы
+        self.appinfos: List[AppInfo] = []
+        # Имя элемента -> значения minOccurs всех объявлений элемента с этим атрибутом
+        self.min_occurs: Dict[str, List[str]] = defaultdict(list)
+
+    @classmethod
+    def from_scheme(cls, content: etree.ElementTree) -> 'SchemeIndex':
+        """ Построение индекса по разобранной XSD схеме. """
+        index = cls()
+        xs = content.nsmap['xs']
+        appinfo_tag = f'{{{xs}}}appinfo'
+        choice_tag = f'{{{xs}}}choice'
+        element_tag = f'{{{xs}}}element'
+
+        # Число предков текущего элемента с minOccurs=0 и xs:choice
+        optional = [0]
+        choice = [0]
+        for event, node in etree.iterwalk(content, events=('start', 'end'), tag=etree.Element):
+            if event == 'end':
+                optional.pop()
+                choice.pop()
+                continue
+
+            if node.tag == appinfo_tag:
+                index.appinfos.append(AppInfo(node, optional[-1] > 0, choice[-1] > 0))
+            elif node.tag == element_tag:
+                name, min_occurs = node.get('name'), node.get('minOccurs')
+                if name is not None and min_occurs is not None:
+                    index.min_occurs[name].append(min_occurs)
+
+            optional.append(optional[-1] + _is_zero(node.get('minOccurs')))
+            choice.append(choice[-1] + (node.tag == choice_tag))
+
+        return index
+
+    def is_optional(self, name: str) -> bool:
+        """ Элемент опционален: все его объявления с атрибутом minOccurs имеют minOccurs="0". """
+        return all(min_occurs == '0' for min_occurs in self.min_occurs.get(name, ()))
@@ -0,0 +1,95 @@
+from collections import Counter
+from typing import Any, Dict, List, Tuple, Union
+from .interpreter import Interpreter
+
+# Поддерево выражения: контекст правила и токены поддерева в обратной польской записи
+_Subtree = Tuple[str, Tuple[str, ...]]
+# Разметка выражения: начало поддерева и номер общего поддерева (None - не общее)
+# для каждой позиции стека
+SharedPlan = Tuple[Tuple[int, ...], Tuple[Union[int, None], ...]]
+
+
+class SubexpressionTable:
+    """
+    Общие подвыражения плана проверок формата (КНД, версия).
+    Для каждой позиции токенизированного выражения вычисляется начало поддерева
+    с вершиной в этой позиции (таблица границ), поддеревья-операции с одинаковыми
+    токенами в одном контексте получают общий номер. Поддеревья, которые
+    встречаются в плане больше одного раза, вычисляются интерпретатором
+    один раз для документа, остальные вхождения берут готовое значение.
+    Листья (узлы документа) в таблицу не входят, они кэшируются интерпретатором.
+    """
+    def __init__(self) -> None:
+        # Поддерево -> номер
+        self.ids: Dict[_Subtree, int] = dict()
+        # Номер -> поддерево
+        self.subtrees: List[_Subtree] = []
+        # Номер -> число вхождений в план
+        self.occurrences: Counter = Counter()
+        # Число выражений плана
+        self.exprs = 0
+
+    @classmethod
+    def from_rules(cls, rules: List[Dict[str, Any]],
+                   interpreter: Interpreter) -> 'SubexpressionTable':
+        """ Разметка выражений плана, в проверки добавляется ключ 'shared'. """
+        table = cls()
+
+        marked = []
+        for rule in rules:
+            for assertion in rule['asserts']:
+                # Выражение не удалось разобрать при сборке компендиума
+                if assertion['expr'] is None:
+                    assertion['shared'] = None
+                    continue
+                spans, ids = table._add(assertion['expr'], rule['context'], interpreter)
+                marked.append((assertion, spans, ids))
+
+        # Номера сохраняются только для поддеревьев с повторами
+        for assertion, spans, ids in marked:
+            ids = tuple(node_id if table.occurrences[node_id] > 1 else None for node_id in ids)
+            assertion['shared'] = (spans, ids) if any(node_id is not None for node_id in ids) else None
+
+        return table
+
+    def _add(self, expr: List[str], context: str,
+             interpreter: Interpreter) -> Tuple[Tuple[int, ...], List[Union[int, None]]]:
+        spans = interpreter.get_spans(expr)
+        ids = []
+        for end, start in enumerate(spans, 1):
+            if start == end - 1:
+                # Лист
+                ids.append(None)
+                continue
+
+            subtree = (context, tuple(expr[start:end]))
+            node_id = self.ids.get(subtree)
+            if node_id is None:
+                node_id = self.ids[subtree] = len(self.subtrees)
+                self.subtrees.append(subtree)
+            self.occurrences[node_id] += 1
+            ids.append(node_id)
+
+        self.exprs += 1
+        return tuple(spans), ids
+
+    def report(self, top: int = 10) -> Dict[str, Any]:
+        """
+        Отчёт о дублировании подвыражений в плане:
+        exprs - число выражений, subexpressions - число поддеревьев-операций,
+        unique - число различных поддеревьев, shared - поддеревьев с повторами,
+        saved - повторных вхождений общих поддеревьев (оценка сверху
+        вычислений, которые не выполняются для документа),
+        top - самые частые общие поддеревья (контекст, токены, вхождения).
+        """
+        shared = [(node_id, count) for node_id, count in self.occurrences.items() if count > 1]
+        total = sum(self.occurrences.values())
+        return {
+            'exprs':            self.exprs,
+            'subexpressions':   total,
+            'unique':           len(self.subtrees),
+            'shared':           len(shared),
+            'saved':            sum(count - 1 for _, count in shared),
+            'top':              [(*self.subtrees[node_id], count)
+                                 for node_id, count in sorted(shared, key=lambda item: -item[1])[:top]]
+        }
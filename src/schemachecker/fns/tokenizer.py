@@ -1,11 +1,40 @@
+from functools import lru_cache
+from threading import RLock
 from pyparsing import Literal, Suppress, Word, Combine, Optional, Forward,\
-    ZeroOrMore, Group, nums, srange, oneOf
-from typing import List
+    ZeroOrMore, Group, ParserElement, nums, srange, oneOf
+from typing import List, Tuple
+
+# Число токенизированных выражений в кэше процесса
+CACHE_SIZE = 16384
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _tokenize(expr: str, parser: Forward) -> Tuple[str, ...]:
+    """ Токенизация выражения общей грамматикой, результат кэшируется по строке выражения. """
+    with Tokenizer.lock:
+        owner = Tokenizer.owner
+        owner.stack = []
+        parser.parseString(expr)
+        return tuple(owner.stack)
 
 
 class Tokenizer:
-    def __init__(self) -> None:
+    """
+    Лексер Schematron-выражений.
+    Грамматика строится один раз на процесс и используется всеми экземплярами.
+    Действия разбора пишут токены в стек экземпляра, построившего грамматику,
+    поэтому разбор выполняется под общей блокировкой.
+    packrat - включение мемоизации pyparsing (действует на весь процесс).
+    """
+    # Общая грамматика, её владелец и блокировка разбора
+    grammar: Forward = None
+    owner: 'Tokenizer' = None
+    lock = RLock()
+
+    def __init__(self, packrat: bool = False) -> None:
         self.stack = []
+        if packrat:
+            ParserElement.enablePackrat()
 
     def _push(self, toks: List[str]) -> None:
         self.stack.append(toks[0])
@@ -16,6 +45,14 @@ class Tokenizer:
                 self.stack.append(tok)
 
     def create_tokenizer(self) -> Forward:
+        """ Общая грамматика процесса, строится при первом вызове. """
+        with Tokenizer.lock:
+            if Tokenizer.grammar is None:
+                Tokenizer.grammar = self._create_grammar()
+                Tokenizer.owner = self
+        return Tokenizer.grammar
+
+    def _create_grammar(self) -> Forward:
         general_comp = oneOf('< > = != <= >=')
         bool_and = Literal('and')
         bool_or = Literal('or')
@@ -82,8 +119,6 @@ class Tokenizer:
         expr <<= term + ZeroOrMore((bool_or + term).setParseAction(self._push))
         return expr
 
-    def tokenize_expression(self, expr: str, parser: Forward) -> List[str]:
-        self.stack = []
-        parser.parseString(expr)
-
-        return self.stack
+    @staticmethod
+    def tokenize_expression(expr: str, parser: Forward) -> List[str]:
+        return list(_tokenize(expr, parser))
@@ -1,5 +1,59 @@
 import os
 import sys
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LRUCache:
+    """
+    Кэш с вытеснением давно не использовавшихся элементов (LRU).
+    Размер кэша ограничен суммарным весом элементов budget,
+    вес каждого элемента задаётся при добавлении (по умолчанию 1).
+    """
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        # Суммарный вес элементов в кэше
+        self.size = 0
+        # Статистика обращений
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Получение элемента, элемент становится последним использованным. """
+        try:
+            value, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, weight: int = 1) -> None:
+        """ Добавление элемента с вытеснением давно не использовавшихся элементов. """
+        if key in self._data:
+            self.size -= self._data.pop(key)[1]
+
+        self._data[key] = (value, weight)
+        self.size += weight
+
+        # Элемент, превышающий бюджет в одиночку, всё равно сохраняется
+        while self.size > self.budget and len(self._data) > 1:
+            _, (_, evicted_weight) = self._data.popitem(last=False)
+            self.size -= evicted_weight
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size = 0
 
 
 def uppercase_schemes_names(scheme_root: str):
@@ -0,0 +1,114 @@
+from threading import local
+from typing import Any, Dict, Union
+from lxml import etree
+from .exceptions import ParserError
+
+# Пространство имён расширений Schematron (usch)
+USCH_NS = 'http://www.unisoftware.ru/schematron-extensions'
+
+# Имя проверяемого файла для функции usch:getFileName, своё для каждого потока
+_local_data = local()
+
+
+def _boolean(value: Any) -> bool:
+    """ Приведение значения XPath к логическому типу по правилам XPath 1.0. """
+    if isinstance(value, float):
+        return value == value and value != 0
+    return bool(value)
+
+
+def _string(value: Any) -> str:
+    """ Приведение значения XPath к строке по правилам XPath 1.0. """
+    if isinstance(value, list):
+        if not value:
+            return ''
+        value = value[0]
+        if isinstance(value, etree._Element):
+            return ''.join(value.itertext())
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _usch_get_file_name(context) -> str:
+    return '.'.join(_local_data.xml_file.split('.')[:-1])
+
+
+def _usch_iif(context, cond, true, false):
+    return true if _boolean(cond) else false
+
+
+def _usch_compare_date(context, first_node, second_node) -> bool:
+    return _string(first_node) == _string(second_node)
+
+
+# Регистрация функций usch для вычисления средствами libxml2
+_usch_functions = etree.FunctionNamespace(USCH_NS)
+_usch_functions['getFileName'] = _usch_get_file_name
+_usch_functions['iif'] = _usch_iif
+_usch_functions['compareDate'] = _usch_compare_date
+
+
+class XPathInterpreter:
+    """
+    Интерпретатор, вычисляющий каждое выражение целиком одним
+    скомпилированным etree.XPath с функциями usch.
+    Выражение вычисляется относительно первого узла контекста в документе.
+
+    Вычисление следует XPath 1.0, вердикты отличаются от интерпретатора
+    токенизированных выражений (Interpreter):
+        - сравнения <, >, <=, >= числовые, интерпретатор сравнивает строки
+          (@ИНН < 9 при ИНН="10": здесь False, в интерпретаторе True);
+        - результат арифметики сравнивается с литералом как число,
+          интерпретатор сравнивает float со строкой (@Сум + @КНД = 10 всегда False);
+        - отсутствующий атрибут - пустое множество узлов, сравнение с ним ложно,
+          интерпретатор завершается ParserError, если ветвь вычисляется
+          (not(@Нет=1) or ... здесь True);
+        - count(X) и sum(X) считают узлы под первым узлом контекста,
+          интерпретатор - все узлы //context/X документа;
+        - операнды -, mod, * разбираются полностью, лексер интерпретатора
+          оставляет их частью имени или с пробелом (ParserError или False).
+    """
+    namespaces = {'usch': USCH_NS}
+
+    def __init__(self) -> None:
+        self.xml_content = None
+        # Найденные узлы контекста текущего документа
+        self.contexts: Dict[str, Union[etree.Element, None]] = dict()
+
+    def compile(self, expr: str, result_type: str = 'boolean') -> etree.XPath:
+        """
+        Компиляция выражения в etree.XPath.
+        result_type - функция XPath для приведения результата (boolean, string).
+        """
+        return etree.XPath(f'{result_type}({expr})', namespaces=self.namespaces)
+
+    def _get_context_node(self, context: str) -> Union[etree.Element, None]:
+        if not context:
+            return self.xml_content
+        if context not in self.contexts:
+            nodes = self.xml_content.xpath(f'//{context}')
+            self.contexts[context] = nodes[0] if nodes else None
+        return self.contexts[context]
+
+    def evaluate_expr(self, expr: etree.XPath,
+                      xml_content: etree.ElementTree,
+                      xml_file: str,
+                      context: str,
+                      shared: Any = None) -> Union[bool, str]:
+        # Разметка общих поддеревьев (shared) не используется,
+        # скомпилированное выражение вычисляется libxml2 целиком.
+        # Новый документ, сбрасываем найденные узлы контекста
+        if xml_content is not self.xml_content:
+            self.xml_content = xml_content
+            self.contexts = dict()
+
+        _local_data.xml_file = xml_file
+
+        try:
+            node = self._get_context_node(context)
+            return expr(node if node is not None else xml_content)
+        except Exception as ex:
+            raise ParserError(expr.path, xml_file, ex)
@@ -44,3 +44,13 @@ class QueriesNotFound(InternalPfrError):
 class QueryResultError(InternalPfrError):
     def __init__(self) -> None:
         self.message = 'Ошибка при получении результатов проверки по xquery выражению'
+
+
+class QueryMergeError(InternalPfrError):
+    def __init__(self, reason: str) -> None:
+        self.message = f'Скрипт не может быть объединён с другими xquery скриптами: {reason}'
+
+
+class SessionPoolError(InternalPfrError):
+    def __init__(self, reason: str) -> None:
+        self.message = f'Ошибка пула сессий BaseX: {reason}'
@@ -1,19 +1,48 @@
-import BaseXClient
 import os
 import re
 import signal
 # noinspection PyUnresolvedReferences
 from lxml import etree
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from urllib.parse import unquote
-from struct import pack, unpack
-from typing import List, Dict, Tuple, Any, ClassVar
-from .utils import Flock, RegisterCleanupFunction
+from time import time
+from typing import List, Dict, Tuple, Any, ClassVar, Union
+from .utils import RegisterCleanupFunction
+from .pool import BaseXPool, PooledSession
 from .xquery import Query
 from .exceptions import *
+from ..snapshot import Snapshot
+from ..context import CheckContext, STREAM_THRESHOLD
+from ..xsd import XsdScheme
+
+
+class PfrContext(CheckContext):
+    """ Состояние проверки файла ПФР. """
+    def __init__(self, file: ClassVar[Dict[str, Any]],
+                 stream_threshold: Union[int, None] = None,
+                 max_errors: Union[int, None] = None) -> None:
+        super().__init__(file, stream_threshold, max_errors)
+        # Содержимое файла для передачи в BaseX
+        self.content: str = None
+        # Направление xml файла:
+        # 0 - АДВ, 1 - СЗВ, 2 - ЗНП
+        self.direction = 0
+        # Префикс файла (Атрибут "Код" в компендиуме)
+        self.prefix: str = None
+        # Тип документа (например, АНКЕТА_ЗЛ)
+        self.doc_type: str = None
 
 
 class PfrChecker:
-    def __init__(self, *, root: str):
+    def __init__(self, *, root: str,
+                 stream_threshold: Union[int, None] = STREAM_THRESHOLD,
+                 max_errors: Union[int, None] = None,
+                 doc_mode: str = 'string',
+                 merge_queries: bool = False,
+                 pool_size: int = 1,
+                 pool_timeout: Union[float, None] = None,
+                 fanout: int = 1):
         self.root = root
         # Корневая директория для файлов валидации
         self.xsd_root = os.path.join(root, 'compendium/pfr/compendium/')
@@ -21,11 +50,6 @@ class PfrChecker:
         self.directions = ['АДВ+АДИ+ДСВ 1.17.12д',
                            'СЗВ-М+ИС+УПП 2.36д',
                            'ЗНП+ЗДП 2.24д']
-        # Направление xml файла:
-        # 0 - АДВ, 1 - СЗВ, 2 - ЗНП
-        self.direction = 0
-        # Префикс файла (Атрибут "Код" в компендиуме)
-        self.prefix: str = None
         # Справочники для проверок КОРР файлов
         # (нужны для передачи в переменную $dictFile)
         self.dict_file = os.path.join(self.xsd_root,
@@ -37,15 +61,6 @@ class PfrChecker:
         # Название основного валидационного файла
         self.comp_file = 'ПФР_КСАФ.xml'
 
-        # Название файла ПФР
-        self.xml_file = None
-        # Содержимое файла
-        self.content = None
-        # Содержимое файла в виде etree Element
-        self.xml_content = None
-        # Тип документа (например, АНКЕТА_ЗЛ)
-        self.doc_type = None
-
         # Используемые парсеры
         self.cp_parser = etree.XMLParser(encoding='cp1251',
                                          recover=True,
@@ -58,16 +73,39 @@ class PfrChecker:
         # Компендиум проверочных схем и скриптов
         self.compendium = dict()
 
-        self.session = BaseXClient.Session('localhost', 1984, 'admin', 'admin')
-
-        # Корневая директория BaseX
-        self.db_data = os.path.join(root, 'basex/data/')
-        # Синхронизация воркеров
-        self._sync_worker()
+        # Пул сессий BaseX. Сессия не допускает параллельных запросов,
+        # одновременно проверяется не больше pool_size файлов;
+        # у каждой сессии своя база данных для документов (doc_mode='db')
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.pool = BaseXPool(pool_size, timeout=pool_timeout)
+        # Число сессий пула, по которым распределяются скрипты одного файла.
+        # Скрипты префикса независимы и выполняются только на чтение,
+        # при fanout > 1 время проверки определяется самой долгой частью скриптов,
+        # а не их суммой. При doc_mode='db' документ записывается в базу каждой сессии
+        self.fanout = min(fanout, pool_size)
+        self.executor = ThreadPoolExecutor(self.pool_size) if self.fanout > 1 else None
 
         # Сборщик xquery запросов
         self.query = Query()
 
+        # Размер файла, начиная с которого XSD проверка выполняется потоково.
+        # None - файлы всегда проверяются по полному дереву
+        self.stream_threshold = stream_threshold
+        # Лимит числа ошибок в результате проверки файла, None - без ограничения
+        self.max_errors = max_errors
+        # Способ передачи документа в xquery скрипты:
+        #   string - содержимое файла передаётся в $doc каждому скрипту
+        #            и разбирается BaseX в каждом скрипте (fn:parse-xml);
+        #   db - документ один раз записывается в базу арендованной сессии пула,
+        #        скрипты получают в $doc путь к документу в базе (doc($doc))
+        self.doc_mode = doc_mode
+        # Путь документа в базе сессии
+        self.doc_path = 'check.xml'
+        # Выполнение скриптов префикса единым запросом (один обмен с BaseX на файл),
+        # единые запросы собираются в setup_compendium
+        self.merge_queries = merge_queries
+
         # Регистрируем обработчик сигналов
         register_cleanup_function = RegisterCleanupFunction(
             signals=[signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGHUP, signal.SIGUSR2]
@@ -84,32 +122,32 @@ class PfrChecker:
                 'inspection_items': []
             })
 
-    def _sync_worker(self) -> None:
-        """ Метод синхронизации записи в базы данных BaseX для избежания write lock. """
-        with Flock(os.path.join(self.db_data, '.sync')) as fd:
-            self.db_num = unpack('I', os.read(fd, 4))[0]
-            if self.db_num < os.cpu_count():
-                self.db_num += 1
-                self.db_root = self.db_data + f'xml_db{self.db_num}'
-                os.lseek(fd, 0, os.SEEK_SET)
-                os.write(fd, pack('I', self.db_num))
-            else:
-                raise Exception('Too many BaseX workers')
+    def init_worker(self) -> None:
+        """
+        Инициализация воркера пакетной проверки (см. batch.check_files).
+        Сокеты сессий, унаследованные при fork, не могут использоваться
+        несколькими процессами, воркер открывает собственный пул сессий
+        со своими базами данных. Пул родительского процесса не закрывается:
+        закрытие отправило бы команду выхода в сессии родителя.
+        """
+        self.pool = BaseXPool(self.pool_size, timeout=self.pool_timeout)
+        # Потоки исполнителя не наследуются при fork
+        self.executor = ThreadPoolExecutor(self.pool_size) if self.fanout > 1 else None
 
     # Регистрируем обработку сигналов supervisor
     def _finalize(self):
-        """ Метод для синхронизации процессов через .sync файл при завершении/рестарте. """
-        with Flock(os.path.join(self.db_data, '.sync')) as fd:
-            num = unpack('I', os.read(fd, 4))[0]
-            if num > 0:
-                num -= 1
-                os.lseek(fd, 0, os.SEEK_SET)
-                os.write(fd, pack('I', num))
-            else:
-                raise Exception('Incorrect synchronization value')
+        """
+        Закрытие пула сессий при завершении/рестарте. Базы данных процесса,
+        не удалённые при аварийном завершении, удаляет следующий пул (BaseXPool._drop_stale).
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        if self.pool is not None:
+            self.pool.close()
 
-        if self.session:
-            self.session.close()
+    def get_query_stats(self) -> Dict[str, Union[int, float]]:
+        """ Статистика подготовленных запросов: подготовка (передача текста) и выполнение. """
+        return self.pool.get_stats()
 
     def _get_compendium_definitions(self, direction: int) -> Dict[str, str]:
         """ Метод для получения из компендиума словаря {definition: prefix}. """
@@ -119,9 +157,11 @@ class PfrChecker:
 
         return definitions
 
-    def _get_adv_prefix(self) -> str:
+    def _get_adv_prefix(self, ctx: PfrContext) -> str:
         """ Метод для определения префикса файлов АДВ направлений. """
-        nsmap = self.xml_content.nsmap
+        # Для потоковой проверки разбирается только начало документа
+        xml_content = ctx.head('ТипДокумента')
+        nsmap = xml_content.nsmap
         if nsmap.get(None):
             nsmap['d'] = nsmap.pop(None)
 
@@ -129,13 +169,13 @@ class PfrChecker:
             raise WrongNamespace()
 
         try:
-            doc_type = self.xml_content.find('.//d:ТипДокумента', namespaces=nsmap).text
+            doc_type = xml_content.find('.//d:ТипДокумента', namespaces=nsmap).text
         except AttributeError:
             raise DocTypeNotFound()
 
         prefix = None
 
-        definitions = self._get_compendium_definitions(self.direction)
+        definitions = self._get_compendium_definitions(ctx.direction)
         for definition, _prefix in definitions.items():
             if doc_type in definition:
                 prefix = _prefix
@@ -143,38 +183,40 @@ class PfrChecker:
 
         return prefix
 
-    def _get_nonadv_prefix(self) -> str:
+    @staticmethod
+    def _get_nonadv_prefix(ctx: PfrContext) -> str:
         """ Метод для определения префикса файлов НЕ АДВ направлений. """
         # Префикс файла (СЗВ-М, СТАЖ и т.д.). None для АДВ направлений
-        prefix_list = self.xml_file.split('_')
+        xml_file = ctx.filename
+        prefix_list = xml_file.split('_')
         prefix = None
-        self.direction = 0
-        if 'СЗВ' in self.xml_file or 'ОДВ' in self.xml_file:
+        ctx.direction = 0
+        if 'СЗВ' in xml_file or 'ОДВ' in xml_file:
             prefix = prefix_list[3]
-            self.direction = 1
-        elif 'УППО' in self.xml_file:
+            ctx.direction = 1
+        elif 'УППО' in xml_file:
             prefix = prefix_list[1]
-            self.direction = 1
-        elif 'ЗНП' in self.xml_file or 'ЗДП' in self.xml_file:
+            ctx.direction = 1
+        elif 'ЗНП' in xml_file or 'ЗДП' in xml_file:
             prefix = prefix_list[2]
-            self.direction = 2
+            ctx.direction = 2
 
         return prefix
 
-    def _set_prefix(self) -> None:
+    def _set_prefix(self, ctx: PfrContext) -> None:
         """
         Метод для установки префикса файла для поиска в компендиуме и
         определения направления файла (0 - АДВ, 1 - СЗВ, 2 - ЗНП).
         :return:
         """
-        prefix = self._get_nonadv_prefix()
+        prefix = self._get_nonadv_prefix(ctx)
         if prefix is None:
-            if self.direction == 0:
-                prefix = self._get_adv_prefix()
+            if ctx.direction == 0:
+                prefix = self._get_adv_prefix(ctx)
             if prefix is None:
                 raise PrefixNotFound()
 
-        self.prefix = prefix
+        ctx.prefix = prefix
 
     def _get_compendium_schemes(self, direction: int, prefix: str) -> Dict[str, Any]:
         """ Метод для получения словаря проверочных схем по направлению и префиксу файла. """
@@ -183,6 +225,10 @@ class PfrChecker:
         except AttributeError:
             raise SchemesNotFound(prefix)
 
+    def _get_compendium_merged(self, direction: int, prefix: str) -> Union[Tuple[str, List[str]], None]:
+        """ Метод для получения единого запроса префикса и имён объединённых в нём скриптов. """
+        return self.compendium[self.directions[direction]][prefix].get('merged')
+
     def _get_compendium_queries(self, direction: int, prefix: str) -> Dict[str, Any]:
         """ Метод для получения словаря проверочных xquery скриптов по направлению и префиксу файла. """
         try:
@@ -190,48 +236,79 @@ class PfrChecker:
         except AttributeError:
             raise QueriesNotFound(prefix)
 
-    def _validate_xsd(self, file: ClassVar[Dict[str, Any]]) -> bool:
+    def _validate_xsd(self, ctx: PfrContext) -> bool:
         """ Метод для валидации файла по XSD. """
+        file = ctx.file
         success = True
-        schemes = self._get_compendium_schemes(self.direction, self.prefix)
+        schemes = self._get_compendium_schemes(ctx.direction, ctx.prefix)
         if schemes is None:
-            raise SchemesNotFound(self.prefix)
+            raise SchemesNotFound(ctx.prefix)
 
-        ret_list = []
         for scheme in schemes.values():
             try:
-                scheme.assertValid(self.xml_content)
-            except etree.DocumentInvalid:
-                for error in scheme.error_log:
+                ctx.assert_valid(scheme)
+            except etree.DocumentInvalid as ex:
+                # Лимит применяется только к ошибкам текущей схемы,
+                # ошибки предыдущих схем уже учтены в ctx.reported
+                ret_list = []
+                # Сверх лимита достаточно одной ошибки, чтобы отметить усечение
+                error_log = ex.error_log if ctx.errors_left is None else islice(ex.error_log, ctx.errors_left + 1)
+                for error in error_log:
                     ret_list.append((str(error.line), error.message))
 
-                self._set_error_struct(ret_list, file)
+                self._set_error_struct(ctx.limit_errors(ret_list), file)
 
                 file.verify_result['result'] = 'failed_xsd'
                 file.verify_result['description'] = (
                     f'Ошибка при валидации по xsd схеме файла '
-                    f'{self.xml_file}.')
+                    f'{ctx.filename}.')
                 success = False
 
         return success
 
-    def _execute_query(self, query_file: str, binds: Dict[str, str]) -> str:
-        query = self.session.query(query_file)
-
-        for key, value in binds.items():
-            query.bind(key, value)
+    @staticmethod
+    def _execute_query(slot: PooledSession,
+                       key: Tuple[int, str, Union[str, None]],
+                       query_file: str, binds: Dict[str, str]) -> str:
+        """ Выполнение подготовленного запроса сессии, при первом обращении запрос подготавливается. """
+        query = slot.prepared.get(key)
+        if query is None:
+            start_time = time()
+            query = slot.session.query(query_file)
+            slot.stats['prepare_time'] += time() - start_time
+            slot.stats['prepared'] += 1
+            slot.prepared[key] = query
+        else:
+            slot.stats['hits'] += 1
 
-        return query.execute()
+        try:
+            for key_, value in binds.items():
+                query.bind(key_, value)
+
+            start_time = time()
+            result = query.execute()
+            slot.stats['execute_time'] += time() - start_time
+            slot.stats['executed'] += 1
+            return result
+        except Exception:
+            # Запрос мог стать недействительным (переподключение, ошибка сервера),
+            # при следующем обращении он подготавливается заново
+            slot.prepared.pop(key, None)
+            raise
 
-    def _checkup_adv(self, checkups, q_nsmap, input):
+    @staticmethod
+    def _checkup_adv(checkups: etree.ElementTree,
+                     q_nsmap: Dict[str, str],
+                     doc_type: str) -> List[Dict[str, Any]]:
         """ Метод для получения результатов проверки (ошибок) для АДВ направлений """
+        errors = []
         for checkup in checkups:
             code_presence = checkup.find('./d:КодРезультата', namespaces=q_nsmap)
             if len(code_presence):
                 code = code_presence.text
             else:
                 code = '50'
-            prot_code = self.doc_type or ''
+            prot_code = doc_type or ''
             description = checkup.find('./d:Описание', namespaces=q_nsmap).text or ''
             results = checkup.findall('.//d:Результат', namespaces=q_nsmap)
             element_objs = []
@@ -241,19 +318,20 @@ class PfrChecker:
                                      'expected_value': '',
                                      'name': '',
                                      'value': ''})
-            input.verify_result['asserts'].append({
+            errors.append({
                 'pfr_code': code,
                 'error_code': prot_code,
                 'description': description,
                 'inspection_items': element_objs
             })
+        return errors
 
     @staticmethod
     def _checkup_nonadv(checkups: etree.ElementTree,
                         q_nsmap: Dict[str, str],
-                        block_code: str,
-                        file: ClassVar[Dict[str, Any]]) -> None:
+                        block_code: str) -> List[Dict[str, Any]]:
         """ Метод для получения результатов проверки (ошибок) для НЕ АДВ направлений """
+        errors = []
         for checkup in checkups:
             check_code = checkup.attrib['ID']
             prot_code = '.'.join((block_code, check_code))
@@ -275,52 +353,141 @@ class PfrChecker:
                                      'name': element_name or '',
                                      'value': element_value or ''})
 
-            file.verify_result['asserts'].append({
+            errors.append({
                 'pfr_code': code,
                 'error_code': prot_code,
                 'description': description,
                 'inspection_items': element_objs
             })
+        return errors
+
+    @staticmethod
+    def _to_db_query(query: str) -> str:
+        """ Скрипт, читающий документ из базы данных по пути в $doc, вместо разбора строки. """
+        return query.replace('fn:parse-xml($doc)', 'doc($doc)')
+
+    def _set_doc_mode(self) -> None:
+        """ Подготовка xquery скриптов компендиума к способу передачи документа (self.doc_mode). """
+        if self.doc_mode != 'db':
+            return
+        for prefix_dict in self.compendium.values():
+            for prefix_info in prefix_dict.values():
+                prefix_info['queries'] = {name: self._to_db_query(query)
+                                          for name, query in prefix_info['queries'].items()}
 
-    def _validate_xquery(self, file: ClassVar[Dict[str, Any]]) -> None:
+    def _validate_xquery(self, ctx: PfrContext) -> None:
         """ Метод для валидации файла по xquery выражениям. """
-        binds = {'$doc': f'{self.content}'}
-        if self.direction == 1:
+        file = ctx.file
+        binds = {'$doc': f'{ctx.content}'}
+        if ctx.direction == 1:
             binds.update({'$dictFile': f'{self.dict_file}'})
 
-        queries = self._get_compendium_queries(self.direction, self.prefix)
+        queries = self._get_compendium_queries(ctx.direction, ctx.prefix)
         if queries is None:
-            raise QueriesNotFound(self.prefix)
+            raise QueriesNotFound(ctx.prefix)
+
+        merged = self._get_compendium_merged(ctx.direction, ctx.prefix)
 
-        for query in queries.values():
-            query_result = self._execute_query(query, binds)
+        executed = self._execute_queries(ctx, queries, merged, binds)
 
-            if query_result:
-                check_result = etree.fromstring(query_result, parser=self.parser)
+        for check_result in self._parse_results(queries, merged, executed):
+            # Лимит ошибок исчерпан, остальные результаты не разбираются
+            if ctx.truncated:
+                break
+            if check_result is not None:
                 q_nsmap = check_result.nsmap
                 q_nsmap['d'] = q_nsmap.pop(None)
                 # Запрос возвращает ответ в xml формате, проверяем,
                 # вернулась ли ошибка (Результат != 0)
-                # blocks = check_result.xpath('//БлокПроверок')
-                # for block in blocks:
                 block_code = check_result.attrib['ID']
                 checkups = check_result.xpath(
-                    '//d:Проверка[d:РезультатЗапроса/d:Результат[text()!=0]]',
+                    './/d:Проверка[d:РезультатЗапроса/d:Результат[text()!=0]]',
                     namespaces=q_nsmap
                 )
-                if self.direction:
-                    self._checkup_nonadv(checkups, q_nsmap, block_code, file)
+                if ctx.direction:
+                    errors = self._checkup_nonadv(checkups[:ctx.errors_left], q_nsmap, block_code)
                 else:
-                    self._checkup_adv(checkups, q_nsmap, file)
+                    errors = self._checkup_adv(checkups[:ctx.errors_left], q_nsmap, ctx.doc_type)
+                file.verify_result['asserts'].extend(ctx.limit_errors(errors, len(errors) < len(checkups)))
                 # Обнаружили ошибки
                 if checkups:
                     file.verify_result['result'] = 'failed_xqr'
                     file.verify_result['description'] = (
                         f'Ошибка при валидации по xquery выражению файла '
-                        f'{self.xml_file}.')
+                        f'{ctx.filename}.')
             else:
                 raise QueryResultError()
 
+    def _execute_queries(self, ctx: PfrContext,
+                         queries: Dict[str, str],
+                         merged: Union[Tuple[str, List[str]], None],
+                         binds: Dict[str, str]) -> Tuple[Union[str, None], Dict[str, str]]:
+        """
+        Выполнение xquery скриптов префикса: единого запроса (merged) и скриптов,
+        не вошедших в него. Возвращает результат единого запроса и результаты
+        отдельных скриптов по имени.
+        При fanout > 1 скрипты распределяются по нескольким сессиям пула
+        и выполняются одновременно, порядок результатов восстанавливается
+        при разборе (_parse_results).
+        """
+        units = []
+        merged_names = ()
+        if merged is not None:
+            merged_query, merged_names = merged
+            units.append(((ctx.direction, ctx.prefix, None), merged_query))
+        units.extend(((ctx.direction, ctx.prefix, name), query)
+                     for name, query in queries.items() if name not in merged_names)
+
+        chunks = min(self.fanout, len(units))
+        if chunks <= 1:
+            results = self._execute_units(units, ctx.content, binds)
+        else:
+            futures = [self.executor.submit(self._execute_units, units[idx::chunks], ctx.content, binds)
+                       for idx in range(chunks)]
+            results = dict()
+            for future in futures:
+                results.update(future.result())
+
+        merged_result = results.pop(None, None)
+        return merged_result, results
+
+    def _execute_units(self, units: List[Tuple[Tuple[int, str, Union[str, None]], str]],
+                       content: str,
+                       binds: Dict[str, str]) -> Dict[Union[str, None], str]:
+        """ Выполнение части скриптов префикса в арендованной сессии пула, результаты по имени скрипта. """
+        with self.pool.lease() as slot:
+            if self.doc_mode != 'db':
+                return {key[2]: self._execute_query(slot, key, query, binds) for key, query in units}
+
+            # Документ разбирается BaseX один раз для всех скриптов сессии,
+            # база данных слота используется только арендатором сессии
+            slot.session.replace(self.doc_path, content)
+            try:
+                binds = dict(binds, **{'$doc': f'{slot.db_name}/{self.doc_path}'})
+                return {key[2]: self._execute_query(slot, key, query, binds) for key, query in units}
+            finally:
+                slot.session.execute(f'delete {self.doc_path}')
+
+    def _parse_results(self, queries: Dict[str, str],
+                       merged: Union[Tuple[str, List[str]], None],
+                       executed: Tuple[Union[str, None], Dict[str, str]]) -> List[Union[etree.Element, None]]:
+        """
+        Разбор результатов в порядке скриптов префикса. Результат единого запроса
+        разбивается на результаты скриптов по обёрткам <Валидатор> (см. Query.makeup_query).
+        None - скрипт вернул пустой результат.
+        """
+        merged_result, results = executed
+        check_results = dict()
+        if merged is not None:
+            root = etree.fromstring(merged_result, parser=self.parser)
+            for name, wrapper in zip(merged[1], root):
+                check_results[name] = wrapper[0] if len(wrapper) else None
+
+        for name, query_result in results.items():
+            check_results[name] = etree.fromstring(query_result, parser=self.parser) if query_result else None
+
+        return [check_results.get(name) for name in queries]
+
     def _get_comp_file(self, direction: str) -> Tuple[etree.ElementTree, Dict[str, Any]]:
         """ Метод для получения дерева файла компендиума и простанства имён для указанного направления. """
         with open(os.path.join(self.xsd_root, direction, self.comp_file), 'rb') as handler:
@@ -365,23 +532,31 @@ class PfrChecker:
         schemes = doc_type.xpath('.//d:Валидация/d:Схема/text()', namespaces=nsmap)
         for scheme in schemes:
             scheme = unquote(scheme).replace('\\', '/')
-            with open(os.path.join(self.xsd_root, direction, scheme.lstrip('/')), 'rb') as xsd_handler:
-                parser = self.utf_parser
-                try:
-                    xsd_content = etree.parse(xsd_handler, parser).getroot()
-                except etree.XMLSyntaxError:
-                    parser = self.cp_parser
-                    xsd_handler.seek(0, 0)
-                    try:
-                        xsd_content = etree.parse(xsd_handler, parser).getroot()
-                    except etree.XMLSyntaxError as ex:
-                        raise Exception(f'Ошибка при разборе XSD схемы: {ex}')
-                xsd_scheme = etree.XMLSchema(xsd_content)
+            with open(self._get_scheme_path(direction, scheme), 'rb') as xsd_handler:
+                xsd_scheme = self._parse_scheme(xsd_handler.read(), direction, scheme)
 
             schemes_dict.update({scheme: xsd_scheme})
 
         return schemes_dict
 
+    def _get_scheme_path(self, direction: str, scheme: str) -> str:
+        """ Метод возвращает путь к файлу XSD схемы направления. """
+        return os.path.join(self.xsd_root, direction, scheme.lstrip('/'))
+
+    def _parse_scheme(self, xsd_bytes: bytes, direction: str, scheme: str) -> XsdScheme:
+        """ Метод для разбора и компиляции XSD схемы по содержимому файла. """
+        # Путь к файлу нужен для разрешения относительных xs:include/xs:import
+        base_url = self._get_scheme_path(direction, scheme)
+        try:
+            xsd_content = etree.fromstring(xsd_bytes, self.utf_parser, base_url=base_url)
+        except etree.XMLSyntaxError:
+            try:
+                xsd_content = etree.fromstring(xsd_bytes, self.cp_parser, base_url=base_url)
+            except etree.XMLSyntaxError as ex:
+                raise Exception(f'Ошибка при разборе XSD схемы: {ex}')
+
+        return XsdScheme(xsd_content)
+
     def _get_scenario(self, direction: str, scenario_file: str) -> Tuple[etree.ElementTree, Dict[str, Any]]:
         """ Метод для получения содержимого сценария и пространства имён. """
         with open(os.path.join(self.xsd_root, direction, scenario_file), 'rb') as handler:
@@ -408,17 +583,31 @@ class PfrChecker:
 
         return query_file, validator_file
 
-    def _makeup_queries(self, queries: Dict[str, str]) -> str:
-        """ Метод собирает единый запрос для переданного словаря xquery выражений. """
+    def _makeup_queries(self, queries: Dict[str, str]) -> Union[Tuple[str, List[str]], None]:
+        """
+        Метод собирает единый запрос для переданного словаря xquery выражений.
+        Возвращает запрос и имена вошедших в него скриптов. Скрипты, которые
+        не разбираются лексером или конфликтуют с остальными (QueryMergeError),
+        выполняются по отдельности. None - объединять нечего.
+        """
         self.query.reset_query()
-        # TODO: добавить общую обработку ошибок при сборке компендиума
-        for query in queries.values():
+        names = []
+        for name, query in queries.items():
             try:
-                self.query.tokenize_query(query)
-            except Exception as ex:
-                raise
+                self.query.merge_query(query, f'v{len(names)}')
+                names.append(name)
+            except QueryMergeError:
+                continue
+
+        if len(names) < 2:
+            return None
+        return self.query.makeup_query(), names
 
-        return self.query.makeup_query()
+    def _set_merged_queries(self) -> None:
+        """ Сборка единых запросов префиксов компендиума (self.merge_queries). """
+        for prefix_dict in self.compendium.values():
+            for prefix_info in prefix_dict.values():
+                prefix_info['merged'] = self._makeup_queries(prefix_info['queries']) if self.merge_queries else None
 
     def _get_query_validators(self, doc_type: etree.ElementTree,
                               direction: str,
@@ -454,8 +643,6 @@ class PfrChecker:
                 with open(query_file, 'r', encoding="utf-8") as q_handler:
                     queries_dict.update({validator_file: q_handler.read()})
 
-            # queries_dict = {'query.xquery': self._makeup_queries(queries_dict)}
-
         return queries_dict
 
     def _set_dict_file_content(self) -> None:
@@ -463,7 +650,38 @@ class PfrChecker:
         with open(self.dict_file) as fd:
             self.dict_file_content = fd.read()
 
-    def setup_compendium(self) -> None:
+    def _dump_compendium(self) -> Dict[str, Any]:
+        """
+        Подготовка компендиума к записи в снимок. Скомпилированные XSD схемы
+        не сериализуются, вместо них сохраняется содержимое файлов схем.
+        """
+        compendium = dict()
+        for direction, prefix_dict in self.compendium.items():
+            compendium[direction] = dict()
+            for prefix, prefix_info in prefix_dict.items():
+                schemes = dict()
+                for scheme in prefix_info['schemes']:
+                    with open(self._get_scheme_path(direction, scheme), 'rb') as xsd_handler:
+                        schemes[scheme] = xsd_handler.read()
+                compendium[direction][prefix] = {**prefix_info, 'schemes': schemes}
+
+        return {
+            'compendium':           compendium,
+            'dict_file_content':    self.dict_file_content
+        }
+
+    def _restore_compendium(self, data: Dict[str, Any]) -> None:
+        """ Восстановление компендиума из снимка, XSD схемы компилируются заново. """
+        self.dict_file_content = data['dict_file_content']
+        self.compendium = dict()
+        for direction, prefix_dict in data['compendium'].items():
+            self.compendium[direction] = dict()
+            for prefix, prefix_info in prefix_dict.items():
+                schemes = {scheme: self._parse_scheme(xsd_bytes, direction, scheme)
+                           for scheme, xsd_bytes in prefix_info['schemes'].items()}
+                self.compendium[direction][prefix] = {**prefix_info, 'schemes': schemes}
+
+    def setup_compendium(self, snapshot: str = None) -> None:
         """
         Сборка компендиума в памяти. Для каждого из трёх направлений:
             - Получение etree.ElementTree для файла компендиума ПФР_КСАФ.xml и пространства имён;
@@ -485,11 +703,30 @@ class PfrChecker:
                         "name.xquery": str,
                         ...
                     },
-                    'definition': str  # Определение документа, нода "ОпределениеДокумента" в ПФР_КСАФ
+                    'definition': str,  # Определение документа, нода "ОпределениеДокумента" в ПФР_КСАФ
+                    'merged': (str, [str])  # Единый запрос и имена вошедших в него скриптов, None - не собран
                 }
             }
         }
+
+        snapshot - путь к снимку компендиума. Действующий снимок загружается вместо
+        разбора файлов компендиума, сценариев и xquery скриптов, иначе компендиум
+        собирается заново и записывается в снимок.
+        Снимок хранит исходные xquery скрипты, при doc_mode='db' они
+        переводятся на чтение документа из базы после загрузки (_set_doc_mode).
         """
+        # Подготовленные запросы относятся к прежним скриптам компендиума
+        self.pool.invalidate()
+
+        if snapshot is not None:
+            snapshot = Snapshot(snapshot, self.xsd_root)
+            data = snapshot.load()
+            if data is not None:
+                self._restore_compendium(data)
+                self._set_doc_mode()
+                self._set_merged_queries()
+                return
+
         # TODO: отлов исключений?
         self.compendium = dict()
 
@@ -521,32 +758,38 @@ class PfrChecker:
 
             self.compendium.update({direction: prefix_dict})
 
+        if snapshot is not None:
+            snapshot.dump(self._dump_compendium())
+        self._set_doc_mode()
+        self._set_merged_queries()
+
     def check_file(self, file: ClassVar[Dict[str, Any]]) -> None:
-        self.xml_file = file.filename
+        """
+        Проверка файла. Состояние проверки хранится в PfrContext, метод можно
+        вызывать одновременно из нескольких потоков, каждая проверка
+        арендует сессию пула BaseX (не больше pool_size проверок одновременно).
+        """
+        ctx = PfrContext(file, self.stream_threshold, self.max_errors)
         # Серверная сторона BaseX некорректно работает с кодировкой cp1251
         if file.charset == 'cp1251':
-            self.content = file.content.encode().decode('utf-8')
-            self.content = re.sub('encoding="windows-1251"',
-                                  'encoding="utf-8"',
-                                  self.content,
-                                  flags=re.IGNORECASE)
+            ctx.content = file.content.encode().decode('utf-8')
+            ctx.content = re.sub('encoding="windows-1251"',
+                                 'encoding="utf-8"',
+                                 ctx.content,
+                                 flags=re.IGNORECASE)
         else:
-            self.content = file.content
-        self.xml_content = file.xml_tree
+            ctx.content = file.content
 
         file.verify_result = dict()
 
         file.verify_result['result'] = 'passed'
         file.verify_result['asserts'] = []
 
-        # Открытие сессии BaseX
-        self.session.execute(f'open xml_db{self.db_num}')
-
-        self._set_prefix()
+        self._set_prefix(ctx)
 
         # Проверка по XSD
-        if not self._validate_xsd(file):
+        if not self._validate_xsd(ctx):
             return
 
         # Проверка по xquery выражениям
-        self._validate_xquery(file)
+        self._validate_xquery(ctx)
@@ -0,0 +1,232 @@
+import BaseXClient
+import hashlib
+import os
+import re
+import socket
+import uuid
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from threading import Lock
+from time import time
+from typing import Dict, Iterator, Tuple, Union
+from .exceptions import SessionPoolError
+
+
+def _read_id(path: str) -> str:
+    try:
+        with open(path) as fd:
+            return fd.read().strip()
+    except OSError:
+        return ''
+
+
+def _get_host_tag() -> str:
+    """
+    Метка пространства pid, в котором выполняется процесс: имя хоста,
+    идентификатор загрузки системы и пространство имён pid (контейнер).
+    Номер процесса в имени базы данных однозначен только вместе с меткой.
+    """
+    try:
+        pid_ns = str(os.stat('/proc/self/ns/pid').st_ino)
+    except OSError:
+        pid_ns = ''
+    boot_id = _read_id('/proc/sys/kernel/random/boot_id') or str(uuid.getnode())
+    owner = '/'.join((socket.gethostname(), boot_id, pid_ns))
+    return hashlib.blake2b(owner.encode(), digest_size=4).hexdigest()
+
+
+class PooledSession:
+    """
+    Сессия пула: соединение с BaseX, база данных слота и подготовленные запросы.
+    Сессия выдаётся одному потоку (BaseXPool.lease), база данных слота
+    используется только владельцем сессии.
+    """
+    def __init__(self, slot: int, db_name: str) -> None:
+        self.slot = slot
+        self.db_name = db_name
+        self.session: BaseXClient.Session = None
+        # Подготовленные запросы по ключу (направление, префикс, скрипт),
+        # для единого запроса префикса имя скрипта - None.
+        # Текст скрипта передаётся серверу один раз, для каждого файла
+        # запрос только связывается с переменными и выполняется
+        self.prepared: Dict[Tuple[int, str, Union[str, None]], BaseXClient.Query] = dict()
+        # Поколение компендиума, к которому относятся подготовленные запросы
+        self.generation = 0
+        # Статистика подготовки и выполнения запросов (время в секундах)
+        self.stats = {
+            'prepared':         0,  # Число подготовленных запросов (текст передан серверу)
+            'prepare_time':     0.,
+            'hits':             0,  # Выполнений подготовленного ранее запроса
+            'executed':         0,
+            'execute_time':     0.
+        }
+        # Соединение исправно на момент последнего использования
+        self.healthy = False
+        self.last_used = 0.
+
+    def close_prepared(self) -> None:
+        for query in self.prepared.values():
+            try:
+                query.close()
+            except Exception:
+                # Сессия могла быть закрыта сервером, запросы закрыты вместе с ней
+                pass
+        self.prepared = dict()
+
+
+class BaseXPool:
+    """
+    Пул сессий BaseX. Каждая сессия пула (слот) работает со своей базой данных
+    {db_prefix}_{метка хоста}_{pid}_{слот}, база создаётся при подключении сессии
+    и удаляется при закрытии пула. Базы завершившихся аварийно процессов
+    удаляются при создании пула, поэтому число воркеров не ограничено
+    заранее созданными базами. Сервер BaseX может быть общим для нескольких
+    хостов и контейнеров, поэтому удаляются только базы с меткой своего
+    хоста (_get_host_tag), для которых проверка pid достоверна.
+
+    Перед выдачей сессия проверяется, если она простаивала дольше check_interval
+    или при прошлой аренде возникла ошибка; неисправная сессия переподключается.
+    """
+    def __init__(self, size: int = 1, *,
+                 host: str = 'localhost',
+                 port: int = 1984,
+                 user: str = 'admin',
+                 password: str = 'admin',
+                 db_prefix: str = 'xml_db',
+                 timeout: Union[float, None] = None,
+                 check_interval: float = 30.) -> None:
+        if size < 1:
+            raise SessionPoolError(f'неверный размер пула {size}')
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.db_prefix = db_prefix
+        # Время ожидания свободной сессии в секундах, None - без ограничения
+        self.timeout = timeout
+        self.check_interval = check_interval
+
+        self.host_tag = _get_host_tag()
+        self.slots = [PooledSession(slot, f'{db_prefix}_{self.host_tag}_{os.getpid()}_{slot}')
+                      for slot in range(size)]
+        # Последняя освободившаяся сессия выдаётся первой, её соединение и запросы "горячие"
+        self.idle = LifoQueue()
+        # Поколение компендиума, увеличивается при его перезагрузке (invalidate)
+        self.generation = 0
+        self.reconnects = 0
+        self.closed = False
+        self.lock = Lock()
+
+        for slot in self.slots:
+            self._connect(slot)
+            self.idle.put(slot)
+        self._drop_stale(self.slots[0])
+
+    def _connect(self, slot: PooledSession) -> None:
+        """ Подключение сессии слота, база данных слота создаётся при отсутствии. """
+        if slot.session is not None:
+            self.reconnects += 1
+            try:
+                slot.session.close()
+            except Exception:
+                pass
+            slot.session = None
+        # Подготовленные запросы закрываются сервером вместе с сессией
+        slot.prepared = dict()
+
+        slot.session = BaseXClient.Session(self.host, self.port, self.user, self.password)
+        slot.session.execute(f'check {slot.db_name}')
+        slot.generation = self.generation
+        slot.healthy = True
+        slot.last_used = time()
+
+    @staticmethod
+    def _ping(slot: PooledSession) -> bool:
+        try:
+            return slot.session.execute('xquery 1') == '1'
+        except Exception:
+            return False
+
+    def _drop_stale(self, slot: PooledSession) -> None:
+        """ Удаление баз данных слотов процессов этого хоста, которые уже не существуют. """
+        names = slot.session.execute('xquery string-join(db:list(), " ")').split()
+        # Базы других хостов и контейнеров не рассматриваются,
+        # их процессы нельзя проверить отсюда
+        pattern = re.compile(rf'{re.escape(self.db_prefix)}_{self.host_tag}_(\d+)_\d+')
+        for name in names:
+            match = pattern.fullmatch(name)
+            if match is None:
+                continue
+            try:
+                os.kill(int(match.group(1)), 0)
+            except ProcessLookupError:
+                slot.session.execute(f'drop db {name}')
+            except PermissionError:
+                # Процесс существует и принадлежит другому пользователю
+                pass
+
+    def _prepare(self, slot: PooledSession) -> None:
+        """ Проверка сессии перед выдачей и сброс устаревших подготовленных запросов. """
+        if slot.session is None or \
+                (not slot.healthy or time() - slot.last_used > self.check_interval) and not self._ping(slot):
+            self._connect(slot)
+        if slot.generation != self.generation:
+            slot.close_prepared()
+            slot.generation = self.generation
+        slot.healthy = True
+
+    @contextmanager
+    def lease(self) -> Iterator[PooledSession]:
+        """ Аренда свободной сессии пула на время проверки файла. """
+        if self.closed:
+            raise SessionPoolError('пул закрыт')
+        try:
+            slot = self.idle.get(timeout=self.timeout)
+        except Empty:
+            raise SessionPoolError(f'нет свободной сессии в течение {self.timeout} с')
+
+        try:
+            self._prepare(slot)
+            yield slot
+        except Exception:
+            # Состояние соединения неизвестно (ошибка запроса или обрыв),
+            # сессия проверяется перед следующей выдачей
+            slot.healthy = False
+            raise
+        finally:
+            slot.last_used = time()
+            self.idle.put(slot)
+
+    def invalidate(self) -> None:
+        """ Сброс подготовленных запросов всех сессий (перезагрузка компендиума). """
+        with self.lock:
+            self.generation += 1
+
+    def get_stats(self) -> Dict[str, Union[int, float]]:
+        """ Суммарная статистика запросов сессий пула. """
+        stats = dict.fromkeys(self.slots[0].stats, 0)
+        for slot in self.slots:
+            for key, value in slot.stats.items():
+                stats[key] += value
+        stats['cached'] = sum(len(slot.prepared) for slot in self.slots)
+        stats['reconnects'] = self.reconnects
+        return stats
+
+    def close(self) -> None:
+        """ Удаление баз данных слотов и закрытие сессий пула. """
+        self.closed = True
+        for slot in self.slots:
+            if slot.session is None:
+                continue
+            try:
+                slot.session.execute('close')
+                slot.session.execute(f'drop db {slot.db_name}')
+            except Exception:
+                # База будет удалена при создании следующего пула
+                pass
+            try:
+                slot.session.close()
+            except Exception:
+                pass
+            slot.session = None
+            slot.prepared = dict()
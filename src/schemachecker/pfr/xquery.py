@@ -1,6 +1,7 @@
 import io
+import re
 from string import printable, whitespace
-from typing import List, Dict, Tuple
+from typing import Any, List, Dict, Tuple
 from pyparsing import Literal, Suppress, Group, Word, ZeroOrMore, Optional, alphanums
 from pyparsing import ParseBaseException
 
@@ -8,6 +9,7 @@ import os
 import BaseXClient
 # noinspection PyUnresolvedReferences
 from lxml import etree
+from .exceptions import QueryMergeError
 
 
 class Query:
@@ -104,7 +106,7 @@ class Query:
         # TODO: избавиться от лишних символов в словах в соответствии со стандартом.
         element = Word(alphabet + alphabet.upper() + alphanums + '$@/:._-()?*')
 
-        var_name = Word(alphanums + '$')
+        var_name = Word(alphanums + '$_.-')
         var_value = Word(alphabet + alphabet.upper() + alphanums + '$@/:._-()[]?*"\'= ')
 
         func_name = Word(alphanums + '-_')
@@ -150,6 +152,78 @@ class Query:
         except ParseBaseException as ex:
             raise Exception(ex)
 
+    def _parse(self, query: str) -> Dict[str, Any]:
+        """
+        Разбор отдельного скрипта без изменения собранного запроса.
+        Скрипт должен разбираться лексером целиком и содержать одно тело запроса.
+        """
+        state = self.default_namespaces, self.namespaces, self.variables, self.functions, self.blocks
+        self.reset_query()
+        try:
+            self.tokenizer.parseString(query, parseAll=True)
+            parts = {
+                'default_namespaces':   self.default_namespaces,
+                'namespaces':           self.namespaces,
+                'variables':            self.variables,
+                'functions':            self.functions,
+                'blocks':               self.blocks
+            }
+        except ParseBaseException as ex:
+            raise QueryMergeError(str(ex))
+        finally:
+            self.default_namespaces, self.namespaces, self.variables, self.functions, self.blocks = state
+
+        # Объявление, не разобранное лексером, попало бы в тело запроса
+        if len(parts['blocks']) != 1 or parts['blocks'][0].lstrip().startswith('declare'):
+            raise QueryMergeError('тело запроса не выделено')
+        return parts
+
+    @staticmethod
+    def _rename(query: str, variables: List[str], functions: List[str], suffix: str) -> str:
+        """ Переименование переменных и функций local: во всём тексте скрипта. """
+        for name in variables:
+            query = re.sub(rf'{re.escape(name)}(?![\w.-])', f'{name}_{suffix}', query)
+        for name in functions:
+            query = re.sub(rf'local:{re.escape(name)}(?![\w.-])', f'local:{name}_{suffix}', query)
+        return query
+
+    def merge_query(self, query: str, suffix: str) -> None:
+        """
+        Добавление скрипта в единый запрос. Переменные и функции local:, объявленные
+        в скрипте иначе, чем в уже добавленных скриптах, переименовываются
+        с суффиксом suffix. При ошибке (QueryMergeError) собранный запрос не изменяется.
+        """
+        renamed_vars, renamed_funcs = set(), set()
+        while True:
+            parts = self._parse(self._rename(query, sorted(renamed_vars), sorted(renamed_funcs), suffix))
+
+            if self.default_namespaces and parts['default_namespaces'] != self.default_namespaces[:1]:
+                raise QueryMergeError('другое пространство имён по умолчанию')
+            for ns_name, ns_descr in parts['namespaces'].items():
+                if self.namespaces.get(ns_name, ns_descr) != ns_descr:
+                    raise QueryMergeError(f'конфликт пространства имён {ns_name}')
+
+            # Переименование может изменить тела других объявлений, повторяем до отсутствия конфликтов
+            conflict_vars = {name for name, descr in parts['variables'].items()
+                             if self.variables.get(name, descr) != descr}
+            conflict_funcs = {name for name, descr in parts['functions'].items()
+                              if self.functions.get(name, descr) != descr}
+            if not conflict_vars and not conflict_funcs:
+                break
+            for name in conflict_vars:
+                # Внешние переменные связываются по имени, их нельзя переименовать
+                if 'external' in parts['variables'][name][1].split():
+                    raise QueryMergeError(f'конфликт внешней переменной {name}')
+            renamed_vars |= conflict_vars
+            renamed_funcs |= conflict_funcs
+
+        if not self.default_namespaces:
+            self.default_namespaces = parts['default_namespaces']
+        self.namespaces.update(parts['namespaces'])
+        self.variables.update(parts['variables'])
+        self.functions.update(parts['functions'])
+        self.blocks.extend(parts['blocks'])
+
     def makeup_query(self) -> str:
         """ Метод формирует новый xquery запрос из внутренних структур. """
         with io.StringIO() as buffer:
@@ -168,11 +242,12 @@ class Query:
             for func_name, func_descr in self.functions.items():
                 buffer.write(f'declare function local:{func_name}{func_descr[0]}{func_descr[1]};\n')
 
-            # Добавляем блоки (необходима обёртка <БлокПроверок></БлокПроверок>)
-            buffer.write('<БлокПроверок>\n')
+            # Добавляем блоки, результат каждого скрипта в своей обёртке <Валидатор>
+            # для разбора результата по скриптам в порядке их добавления
+            buffer.write('<Результаты>\n')
             for block in self.blocks:
-                buffer.write(f'{block}\n')
-            buffer.write('</БлокПроверок>')
+                buffer.write(f'<Валидатор>{{\n{block}\n}}</Валидатор>\n')
+            buffer.write('</Результаты>')
 
             query = buffer.getvalue()
 
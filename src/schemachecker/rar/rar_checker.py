@@ -1,23 +1,23 @@
 import os
 import re
+from itertools import islice
 # noinspection PyUnresolvedReferences
 from lxml import etree
-from typing import List, Tuple, ClassVar, Dict, Any
+from typing import List, Tuple, ClassVar, Dict, Any, Union
 from .exceptions import *
+from ..context import CheckContext, STREAM_THRESHOLD
+from ..xsd import XsdScheme
 
 
 class RarChecker:
-    def __init__(self, *, root: str) -> None:
+    def __init__(self, *, root: str,
+                 stream_threshold: Union[int, None] = STREAM_THRESHOLD,
+                 max_errors: Union[int, None] = None) -> None:
         self.root = root
         # Корневая директория для файлов валидации
         self.xsd_root = os.path.join(root, 'compendium/')
         self.compendium = dict()
 
-        self.filename = None
-        self.xml_content = None
-        self.xsd_content: etree.ElementTree = None
-        self.xsd_scheme: etree.XMLSchema = None
-
         self.charset = 'cp1251'
         self.parser = etree.XMLParser(encoding=self.charset,
                                       recover=True,
@@ -26,6 +26,12 @@ class RarChecker:
         # Регулярка для имени xsd схемы
         self.xsd_regex = re.compile('(\d+)-o-(\d+)_(\d+)\.xsd')
 
+        # Размер файла, начиная с которого XSD проверка выполняется потоково.
+        # None - файлы всегда проверяются по полному дереву
+        self.stream_threshold = stream_threshold
+        # Лимит числа ошибок в результате проверки файла, None - без ограничения
+        self.max_errors = max_errors
+
     @staticmethod
     def _set_error_struct(err_list: List[Tuple[str, str]], file: ClassVar[Dict[str, Any]]) -> None:
         """ Заполнение структуры ошибки для вывода. """
@@ -36,26 +42,31 @@ class RarChecker:
                 'inspection_items': []
             })
 
-    def _set_scheme(self) -> None:
-        """ Метод установки xsd схемы. """
+    def _get_scheme(self, ctx: CheckContext) -> XsdScheme:
+        """ Метод получения xsd схемы файла. """
+        # Для потоковой проверки разбирается только начало документа
+        xml_content = ctx.head('ФормаОтч')
         try:
-            form_ver = self.xml_content.xpath('//Файл/@ВерсФорм')[0]
-            form_num = self.xml_content.xpath('//Файл/ФормаОтч/@НомФорм')[0]
+            form_ver = xml_content.xpath('//Файл/@ВерсФорм')[0]
+            form_num = xml_content.xpath('//Файл/ФормаОтч/@НомФорм')[0]
         except IndexError:
-            raise SchemeNotFound(self.filename)
+            raise SchemeNotFound(ctx.filename)
 
-        self.xsd_scheme = self.compendium[f'{form_num}.{form_ver}']
+        return self.compendium[f'{form_num}.{form_ver}']
 
-    def _validate_xsd(self, file: ClassVar[Dict[str, Any]]) -> None:
+    def _validate_xsd(self, ctx: CheckContext, xsd_scheme: XsdScheme) -> None:
+        file = ctx.file
         ret_list = []
         try:
-            self.xsd_scheme.assertValid(self.xml_content)
-        except etree.DocumentInvalid:
+            ctx.assert_valid(xsd_scheme)
+        except etree.DocumentInvalid as ex:
             file.verify_result['result'] = 'failed_xsd'
-            for error in self.xsd_scheme.error_log:
+            # Сверх лимита достаточно одной ошибки, чтобы отметить усечение
+            error_log = ex.error_log if ctx.errors_left is None else islice(ex.error_log, ctx.errors_left + 1)
+            for error in error_log:
                 ret_list.append((error.line, error.message))
 
-            self._set_error_struct(ret_list, file)
+            self._set_error_struct(ctx.limit_errors(ret_list), file)
 
     def setup_compendium(self) -> None:
         self.compendium = dict()
@@ -67,21 +78,24 @@ class RarChecker:
                         match_groups = self.xsd_regex.match(file).groups()
                         xsd_comp_name = '.'.join(match_groups)
                         xsd_content = etree.parse(fd, self.parser).getroot()
-                        xsd_scheme = etree.XMLSchema(xsd_content)
+                        xsd_scheme = XsdScheme(xsd_content)
                         self.compendium[xsd_comp_name] = xsd_scheme
                     except etree.XMLSyntaxError as ex:
                         raise XsdParseError(file, ex)
 
     def check_file(self, file: ClassVar[Dict[str, Any]]) -> None:
-        self.filename = file.filename
-        self.xml_content = file.xml_tree
+        """
+        Проверка файла. Состояние проверки хранится в CheckContext,
+        метод можно вызывать одновременно из нескольких потоков.
+        """
+        ctx = CheckContext(file, self.stream_threshold, self.max_errors)
 
         file.verify_result = dict()
 
         file.verify_result['result'] = 'passed'
         file.verify_result['asserts'] = []
 
-        self._set_scheme()
+        xsd_scheme = self._get_scheme(ctx)
 
         # Проверка по xsd
-        self._validate_xsd(file)
+        self._validate_xsd(ctx, xsd_scheme)
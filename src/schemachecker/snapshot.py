@@ -0,0 +1,101 @@
+import hashlib
+import os
+import pickle
+import struct
+from typing import Any, Dict, Tuple, Union
+
+# Версия формата снимка, увеличивается при изменении структуры компендиумов
+SNAPSHOT_VERSION = 3
+
+# Заголовок файла снимка: сигнатура, версия формата, sha256 содержимого
+_MAGIC = b'SCHSNAP'
+_HEADER = struct.Struct(f'{len(_MAGIC)}sI32s')
+# Размер блока чтения исходных файлов при вычислении контрольной суммы
+_CHUNK_SIZE = 1024 * 1024
+
+
+class Snapshot:
+    """
+    Снимок собранного компендиума на диске.
+    Хранит сериализованные pickle структуры вместе со списком исходных файлов
+    компендиума (размер и контрольная сумма содержимого). Время изменения
+    не используется: правка без изменения размера в пределах точности mtime
+    не обнаруживается. Сам снимок, если он лежит внутри source_root,
+    в список не входит. Снимок считается недействительным
+    при несовпадении версии формата, контрольной суммы или исходных файлов,
+    в этом случае компендиум собирается заново и снимок перезаписывается.
+    """
+    def __init__(self, path: str, source_root: str, key: str = '') -> None:
+        self.path = path
+        # Директория с исходными файлами компендиума
+        self.source_root = source_root
+        # Дополнительный ключ снимка (например, параметры сборки компендиума)
+        self.key = key
+
+    def _is_snapshot_file(self, path: str) -> bool:
+        """ Файл снимка или его временный файл (см. dump). """
+        snapshot_path = os.path.realpath(self.path)
+        path = os.path.realpath(path)
+        return path == snapshot_path or path.startswith(f'{snapshot_path}.') and path.endswith('.tmp')
+
+    @staticmethod
+    def _get_digest(path: str) -> bytes:
+        digest = hashlib.blake2b()
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    def _get_manifest(self) -> Dict[str, Tuple[int, bytes]]:
+        """ Словарь исходных файлов компендиума: {путь: (размер, контрольная сумма)}. """
+        manifest = dict()
+        for root, dirs, files in os.walk(self.source_root):
+            for file in files:
+                path = os.path.join(root, file)
+                if self._is_snapshot_file(path):
+                    continue
+                manifest[os.path.relpath(path, self.source_root)] = (os.path.getsize(path), self._get_digest(path))
+
+        return manifest
+
+    def load(self) -> Union[Any, None]:
+        """ Загрузка данных снимка. None - снимок отсутствует или устарел. """
+        try:
+            with open(self.path, 'rb') as fd:
+                header = fd.read(_HEADER.size)
+                payload = fd.read()
+        except IOError:
+            return None
+
+        if len(header) != _HEADER.size:
+            return None
+        magic, version, checksum = _HEADER.unpack(header)
+        if magic != _MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        if hashlib.sha256(payload).digest() != checksum:
+            return None
+
+        try:
+            snapshot = pickle.loads(payload)
+        except Exception:
+            return None
+
+        if snapshot['key'] != self.key or snapshot['manifest'] != self._get_manifest():
+            return None
+
+        return snapshot['data']
+
+    def dump(self, data: Any) -> None:
+        """ Запись снимка. Файл заменяется атомарно, параллельные воркеры читают целый снимок. """
+        payload = pickle.dumps({
+            'key':      self.key,
+            'manifest': self._get_manifest(),
+            'data':     data
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+        header = _HEADER.pack(_MAGIC, SNAPSHOT_VERSION, hashlib.sha256(payload).digest())
+
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(header)
+            fd.write(payload)
+        os.replace(tmp_path, self.path)
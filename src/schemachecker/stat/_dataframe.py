@@ -198,15 +198,18 @@ class DataFrame:
     def _filter_rows_indices(self, rows: List[Union[int, str]]) -> Set[int]:
         """ Метод возвращает индексы строк, удовлетворяющих условиям. """
         row_indices = set()
-        while rows:
-            token = rows.pop()
+        # Список условий не изменяется, разбираем его с конца по курсору
+        pos = len(rows)
+        while pos:
+            pos -= 1
+            token = rows[pos]
             # Все строки
             if token == '*':
                 row_indices.update(range(len(self.row_codes)))
             # Диапазон строк
             elif token == '-':
-                max_r = rows.pop()
-                min_r = rows.pop()
+                pos -= 2
+                min_r, max_r = rows[pos], rows[pos + 1]
                 indices = np.where((self.row_codes > min_r) & (self.row_codes < max_r))[0]
                 row_indices.update(indices.flat)
             # Отдельная строка
@@ -222,13 +225,15 @@ class DataFrame:
         if any(specs):
             spec_indices = [set() for _ in range(len(specs))]
             for sx, spec in enumerate(specs):
-                while spec:
-                    token = spec.pop()
+                pos = len(spec)
+                while pos:
+                    pos -= 1
+                    token = spec[pos]
                     if token == '*':
                         spec_indices[sx].update(row_indices)
                     elif token == '-':
-                        max_s = spec.pop()
-                        min_s = spec.pop()
+                        pos -= 2
+                        min_s, max_s = spec[pos], spec[pos + 1]
                         indices = np.where((self.specs[sx] > min_s) & (self.specs[sx] < max_s))[0]
                         spec_indices[sx].update(indices)
                     else:
@@ -243,13 +248,15 @@ class DataFrame:
     def _filter_cols_indices(self, cols: List[Union[int, str]]) -> Set[int]:
         """ Метод возвращает индексы граф, удовлетворяющих условиям. """
         col_indices = set()
-        while cols:
-            token = cols.pop()
+        pos = len(cols)
+        while pos:
+            pos -= 1
+            token = cols[pos]
             if token == '*':
                 col_indices.update(range(len(self.col_codes)))
             elif token == '-':
-                max_c = cols.pop()
-                min_c = cols.pop()
+                pos -= 2
+                min_c, max_c = cols[pos], cols[pos + 1]
                 indices = np.where((self.col_codes > min_c) & (self.col_codes < max_c))[0]
                 col_indices.update(indices.flat)
             elif type(token) == int:
@@ -1,5 +1,4 @@
 import operator
-from copy import deepcopy
 from ._dataframe import DataFrame
 from .exceptions import InterpreterError, EmptyExtract
 
@@ -18,13 +17,53 @@ class PeriodInterpreter:
             'or':   operator.or_
         }
 
+        # Логические операторы с сокращённым вычислением:
+        # значение левого операнда, при котором правый не вычисляется
+        self.short_circuit_map = {
+            'and':  False,
+            'or':   True
+        }
+
+        # Стек выражения не изменяется при вычислении,
+        # позиция вершины хранится в self.pos
         self.stack = []
+        self.pos = 0
         self._period = period
 
-    def _evaluate_stack(self):
-        op = self.stack.pop()
+    def _pop(self):
+        """ Снятие элемента с вершины стека сдвигом курсора. """
+        self.pos -= 1
+        return self.stack[self.pos]
+
+    def _skip(self):
+        """ Пропуск поддерева на вершине стека без вычисления. """
+        op = self._pop()
 
         if op in self.unary_map:
+            self._skip()
+            self._skip()
+        # Список периодов, "in"
+        elif not op.isdigit() and op != '&np':
+            while self._pop() != '&np':
+                pass
+
+    def _evaluate_stack(self):
+        op = self._pop()
+
+        if op in self.short_circuit_map:
+            # Правый операнд пропускаем и вычисляем только при необходимости
+            right = self.pos
+            self._skip()
+            arg1 = self._evaluate_stack()
+            if bool(arg1) == self.short_circuit_map[op]:
+                return bool(arg1)
+            left = self.pos
+            self.pos = right
+            arg2 = self._evaluate_stack()
+            self.pos = left
+            return self.unary_map[op](arg1, arg2)
+
+        elif op in self.unary_map:
             arg2 = self._evaluate_stack()
             arg1 = self._evaluate_stack()
             return self.unary_map[op](arg1, arg2)
@@ -39,11 +78,13 @@ class PeriodInterpreter:
         # Список периодов, "in"
         else:
             args = []
-            arg = self.stack[-1]
+            arg = self.stack[self.pos - 1]
             while arg != '&np':
                 arg = self._evaluate_stack()
                 args.append(arg)
-                arg = self.stack[-1]
+                arg = self.stack[self.pos - 1]
+            # Снимаем &np, относящийся к списку
+            self._pop()
             return self.period in args
 
     @property
@@ -55,7 +96,8 @@ class PeriodInterpreter:
         self._period = value
 
     def evaluate_expr(self, expr):
-        self.stack = deepcopy(expr)
+        self.stack = expr
+        self.pos = len(expr)
         try:
             return self._evaluate_stack()
         except Exception:
@@ -109,8 +151,10 @@ class Interpreter:
             'coalesce': self._coalesce
         }
 
-        # Стек выражения
+        # Стек выражения не изменяется при вычислении,
+        # позиция вершины хранится в self.pos
         self.stack = []
+        self.pos = 0
         # Флаг условного выражения
         self.condition = False
         # Флаги тернарного сравнения
@@ -213,8 +257,13 @@ class Interpreter:
     def _coalesce():
         pass
 
+    def _pop(self):
+        """ Снятие элемента с вершины стека сдвигом курсора. """
+        self.pos -= 1
+        return self.stack[self.pos]
+
     def _evaluate_stack(self):
-        op = self.stack.pop()
+        op = self._pop()
 
         # Вытащили элемент
         if type(op) == list:
@@ -257,6 +306,9 @@ class Interpreter:
                 return self.bool_map[op](arg1, arg2), arg2
 
         elif op in self.binary_map:
+            # and/or вычисляют оба операнда: пустая выборка в любом из них
+            # означает, что контроль не применяется (EmptyExtract),
+            # независимо от значения другого операнда
             arg2 = self._evaluate_stack()
             arg1 = self._evaluate_stack()
             arg1, arg2 = self._check_context(arg1, arg2)
@@ -264,7 +316,7 @@ class Interpreter:
 
         elif op in self.ternary_map:
             args = []
-            arg = self.stack[-1]
+            arg = self.stack[self.pos - 1]
             while type(arg) != DataFrame:
                 arg = self._evaluate_stack()
                 args.append(arg)
@@ -287,7 +339,8 @@ class Interpreter:
     def evaluate_expr(self, expr, frame_map) -> bool:
         """ Вычисление контрольного выражения. """
         self.frame_map = frame_map
-        self.stack = deepcopy(expr)
+        self.stack = expr
+        self.pos = len(expr)
         try:
             return self._evaluate_stack()
         except EmptyExtract:
@@ -300,7 +353,8 @@ class Interpreter:
         """ Вычисление условного выражения. """
         self.condition = True
         self.frame_map = frame_map
-        self.stack = deepcopy(expr)
+        self.stack = expr
+        self.pos = len(expr)
         try:
             return self._evaluate_stack()
         except EmptyExtract:
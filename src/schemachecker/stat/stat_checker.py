@@ -8,33 +8,43 @@ from .interpreter import Interpreter, PeriodInterpreter
 from .tokenizer import Tokenizer
 from ._dataframe import DataFrame
 from .exceptions import *
+from ..snapshot import Snapshot
+from ..context import CheckContext
+
+
+class StatContext(CheckContext):
+    """ Состояние проверки статистического отчёта. """
+    def __init__(self, file: ClassVar[Dict[str, Any]],
+                 max_errors: Union[int, None] = None) -> None:
+        super().__init__(file, max_errors=max_errors)
+        self.okud = None
+        # Содержимое xml файла
+        self.xml_report = DotDict()
+        self.xml_title = DotDict()
+        self.xml_sections = DotDict()
+        # Словарь датафреймов, ключи - id секций
+        self.frames = DotDict()
+        # Интерпретаторы хранят состояние вычисления, свои для каждой проверки
+        self.interpreter = Interpreter()
+        self.period_interpreter = PeriodInterpreter()
 
 
 # TODO: make its own class errors
 class StatChecker:
-    def __init__(self, *, root):
+    def __init__(self, *, root, packrat=False, max_errors: Union[int, None] = None):
         self.root = root
+        # Лимит числа ошибок в результате проверки файла, None - без ограничения
+        self.max_errors = max_errors
         self.parser = etree.XMLParser(encoding='utf-8',
                                       recover=True,
                                       remove_comments=True)
-        # Содержимое xml файла
-        self.xml_report = DotDict()
-        self.xml_title = DotDict()
-        self.xml_sections = DotDict()
-        self.filename = None
-        self.content = None
-        self.okud = None
 
         # Содержимое компендиума проверочных схем
         self.compendium = DotDict()
 
-        # Словарь датафреймов, ключи - id секций
-        self.frames = DotDict()
-
-        # Подготовка лексера и интерпретатора
-        self.interpreter = Interpreter()
-        self.period_interpreter = PeriodInterpreter()
-        self.tokenizer = Tokenizer()
+        # Подготовка лексера. Интерпретаторы создаются для каждой проверки в StatContext.
+        # Грамматики лексера общие для процесса, packrat включает мемоизацию pyparsing
+        self.tokenizer = Tokenizer(packrat)
         self.condition, self.log_expr, self.period_cond = self.tokenizer.create_tokenizer()
 
     @staticmethod
@@ -47,9 +57,8 @@ class StatChecker:
                 'inspection_items': []
             })
 
-    def process_input(self, filename, content):
-        self.filename = filename
-        self.content = content
+    def process_input(self, ctx: StatContext) -> None:
+        filename = ctx.filename
         # Убираем расширение
         pure_filename = filename.split('.')[0]
 
@@ -64,42 +73,42 @@ class StatChecker:
         try:
             _okud, _idf, _idp, _okpo, _year = file_info[:5]
             _period = file_info[5]
-            self.period_interpreter.period = _period
+            ctx.period_interpreter.period = _period
             # Уникальный идентификатор формы - ОКУД + IDF
-            self.okud = f'{_okud}_{int(_idf)}'
+            ctx.okud = f'{_okud}_{int(_idf)}'
             if len(file_info) > 6:
                 # Дополнительная, необязательная информация
                 _extinfo = file_info[6:]
         except IndexError:
-            raise InputError(self.filename,
+            raise InputError(filename,
                              'Формат названия файла не распознан')
         except ValueError:
-            raise InputError(self.filename,
+            raise InputError(filename,
                              'Невалидная информация в заголовке файла')
 
         # Данные о статистическом отчёте
-        self.xml_report = DotDict(self.content.items())
+        ctx.xml_report = DotDict(ctx.xml_content.items())
 
         # Данные титульной страницы отчёта
         try:
-            title_items = self.content.xpath('/report/title//item')
+            title_items = ctx.xml_content.xpath('/report/title//item')
             for item in title_items:
-                self.xml_title[item.attrib['name']] = item.attrib['value']
+                ctx.xml_title[item.attrib['name']] = item.attrib['value']
         except KeyError as ex:
-            raise InputError(self.filename,
+            raise InputError(filename,
                              f'Не найден обязательный атрибут в элементе item: {ex}')
 
         # Данные о разделах
-        sections = self.content.xpath('/report/sections//section')
+        sections = ctx.xml_content.xpath('/report/sections//section')
         for section in sections:
             sec_code = section.attrib['code']
             try:
-                self.frames[sec_code] = \
+                ctx.frames[sec_code] = \
                     DataFrame.from_file_content(
-                        section, self.compendium[self.okud].sections[sec_code]
+                        section, self.compendium[ctx.okud].sections[sec_code]
                     )
             except KeyError as ex:
-                raise InputError(self.filename,
+                raise InputError(filename,
                                  f'Не найден обязательный атрибут в разделе sections: {ex}')
 
     @staticmethod
@@ -332,7 +341,7 @@ class StatChecker:
 
         return dics
 
-    def setup_compendium(self) -> None:
+    def setup_compendium(self, snapshot: str = None) -> None:
         """
         Сборка комепендиума в памяти. Для каждой проверочной формы:
             - Получение метаинформации из атрибутов корневого элемента metaForm;
@@ -402,10 +411,22 @@ class StatChecker:
                 }
             }
         }
+
+        snapshot - путь к снимку компендиума с токенизированными контролями.
+        Действующий снимок загружается вместо разбора файлов metaForm,
+        иначе компендиум собирается заново и записывается в снимок.
         """
+        comp_root = os.path.join(self.root, 'compendium')
+
+        if snapshot is not None:
+            snapshot = Snapshot(snapshot, comp_root)
+            compendium = snapshot.load()
+            if compendium is not None:
+                self.compendium = compendium
+                return
+
         self.compendium = DotDict()
 
-        comp_root = os.path.join(self.root, 'compendium')
         for root, dirs, files in os.walk(comp_root):
             for file in files:
                 with open(os.path.join(root, file), 'r') as handler:
@@ -435,11 +456,17 @@ class StatChecker:
                 if _okud:
                     self.compendium[f'{_okud}_{int(_idf)}'] = scheme
                 else:
-                    raise OkudError(self.filename)
+                    raise OkudError(file)
+
+        if snapshot is not None:
+            snapshot.dump(self.compendium)
 
     def check_file(self, file: ClassVar[Dict[str, Any]]) -> None:
-        self.filename = file.filename
-        self.content = file.xml_tree
+        """
+        Проверка файла. Состояние проверки хранится в StatContext,
+        метод можно вызывать одновременно из нескольких потоков.
+        """
+        ctx = StatContext(file, self.max_errors)
 
         file.verify_result = dict()
 
@@ -448,37 +475,40 @@ class StatChecker:
 
         ret_list = []
         try:
-            self.process_input(self.filename, self.content)
+            self.process_input(ctx)
         except InputError as ex:
             file.verify_result['result'] = 'failed'
             ret_list.append(('', str(ex)))
-            self._set_error_struct(ret_list, file)
+            self._set_error_struct(ctx.limit_errors(ret_list), file)
             return
 
-        schema = self.compendium.get(self.okud)
+        schema = self.compendium.get(ctx.okud)
         if schema is None:
-            raise Exception(f'Не найдена проверочная схема для ОКУД {self.okud}')
+            raise Exception(f'Не найдена проверочная схема для ОКУД {ctx.okud}')
         # В схеме не содержится проверочных выражений
         if schema.controls is None:
             return
 
-        for control in self.compendium[self.okud].controls:
+        for control in self.compendium[ctx.okud].controls:
+            # Найдена ошибка сверх лимита, дальнейшие проверки не нужны
+            if ctx.errors_left is not None and len(ret_list) > ctx.errors_left:
+                break
             # Секция, для которой выполняется проверка
             r_sec = str(control.section[0])
             # Секция заполнена
-            if self.frames[r_sec].data.size != 0:
+            if ctx.frames[r_sec].data.size != 0:
                 period_cond = True
                 condition = True
                 try:
                     if control.period:
-                        period_cond = self.period_interpreter\
+                        period_cond = ctx.period_interpreter\
                             .evaluate_expr(control.period)
                     if control.condition:
-                        condition = self.interpreter\
-                            .evaluate_expr_cond(control.condition, self.frames)
+                        condition = ctx.interpreter\
+                            .evaluate_expr_cond(control.condition, ctx.frames)
                     if period_cond and condition:
-                        ret = self.interpreter\
-                            .evaluate_expr(control.rule, self.frames)
+                        ret = ctx.interpreter\
+                            .evaluate_expr(control.rule, ctx.frames)
                         # Проверка не выполнена, формируем отчёт с ошибкой
                         if not ret:
                             ret_list.append((control.id, control.name))
@@ -488,5 +518,5 @@ class StatChecker:
                     return
 
         if len(ret_list):
-            self._set_error_struct(ret_list, file)
+            self._set_error_struct(ctx.limit_errors(ret_list), file)
             file.verify_result['result'] = 'failed'
@@ -1,9 +1,42 @@
+from functools import lru_cache
+from threading import RLock
 from pyparsing import Word, Literal, ZeroOrMore, Forward, Keyword,\
-    Combine, Group, Suppress, Optional, oneOf, srange, nums
+    Combine, Group, Suppress, Optional, ParserElement, oneOf, srange, nums
+
+# Число токенизированных выражений в кэше процесса
+CACHE_SIZE = 16384
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _tokenize(expr, parser_type):
+    """ Токенизация выражения общей грамматикой, результат кэшируется по строке выражения. """
+    with Tokenizer.lock:
+        owner = Tokenizer.owner
+        owner.stack = []
+        owner.axis = []
+        owner.coords = []
+        owner.args = 0
+        parser_type.parseString(expr)
+        return tuple(owner.stack)
 
 
 class Tokenizer:
-    def __init__(self):
+    """
+    Лексер контрольных соотношений.
+    Грамматики строятся один раз на процесс и используются всеми экземплярами.
+    Действия разбора пишут токены в стек экземпляра, построившего грамматики,
+    поэтому разбор выполняется под общей блокировкой.
+    packrat - включение мемоизации pyparsing (действует на весь процесс).
+    """
+    # Общие грамматики (условие, логическое выражение, условие на период),
+    # их владелец и блокировка разбора
+    grammars = None
+    owner = None
+    lock = RLock()
+
+    def __init__(self, packrat=False):
+        if packrat:
+            ParserElement.enablePackrat()
         # Стек выражения
         self.stack = []
         # Вспомогательные массивы для формирования элементов
@@ -48,6 +81,14 @@ class Tokenizer:
         self.axis.append('-')
 
     def create_tokenizer(self):
+        """ Общие грамматики процесса, строятся при первом вызове. """
+        with Tokenizer.lock:
+            if Tokenizer.grammars is None:
+                Tokenizer.grammars = self._create_grammars()
+                Tokenizer.owner = self
+        return Tokenizer.grammars
+
+    def _create_grammars(self):
         alphabet = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
 
         general_comp = oneOf('|<| |>| |=| |<>| |<=| |>=|')
@@ -157,8 +198,6 @@ class Tokenizer:
 
         return condition, log_expr, period_cond
 
-    def tokenize_expression(self, expr, parser_type):
-        self.stack = []
-        parser_type.parseString(expr)
-
-        return self.stack
+    @staticmethod
+    def tokenize_expression(expr, parser_type):
+        return list(_tokenize(expr, parser_type))
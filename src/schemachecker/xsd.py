@@ -0,0 +1,68 @@
+from collections import namedtuple
+from threading import Lock, local
+from typing import IO, Union
+# noinspection PyUnresolvedReferences
+from lxml import etree
+
+# Запись журнала для ошибки разбора некорректного документа (поля как у etree._LogEntry)
+_SyntaxLogEntry = namedtuple('_SyntaxLogEntry', ['line', 'message'])
+
+
+class XsdScheme:
+    """
+    Скомпилированная XSD схема, общая для нескольких потоков.
+    Журнал ошибок etree.XMLSchema один на все вызовы, поэтому каждый поток
+    проверяет документы своим экземпляром схемы, скомпилированным при первом
+    обращении потока. Проверки по одной и той же схеме выполняются параллельно,
+    libxml2 отпускает GIL. Память схемы растёт с числом проверяющих потоков.
+    """
+    def __init__(self, xsd_content: etree.ElementTree) -> None:
+        self.xsd_content = xsd_content
+        # Экземпляр схемы текущего потока
+        self._local = local()
+        # Компиляция в конструкторе сообщает об ошибке схемы сразу (etree.XMLSchemaParseError)
+        self._local.scheme = etree.XMLSchema(xsd_content)
+        # Блокировка компиляции: дерево XSD читается одним потоком
+        self._lock = Lock()
+
+    @property
+    def scheme(self) -> etree.XMLSchema:
+        """ Экземпляр схемы текущего потока. """
+        scheme = getattr(self._local, 'scheme', None)
+        if scheme is None:
+            with self._lock:
+                scheme = self._local.scheme = etree.XMLSchema(self.xsd_content)
+        return scheme
+
+    def assert_valid(self, xml_content: etree.ElementTree) -> None:
+        """
+        Аналог etree.XMLSchema.assertValid. Ошибки проверки доступны
+        в ex.error_log исключения etree.DocumentInvalid (копия журнала схемы).
+        """
+        self.scheme.assertValid(xml_content)
+
+    def assert_valid_stream(self, source: Union[str, IO], **options) -> None:
+        """
+        Потоковая проверка документа при разборе (etree.iterparse со схемой).
+        Обработанные элементы удаляются из дерева, в памяти находится
+        только текущая ветвь документа. Журнал ошибок принадлежит разбору.
+        Ошибки, как и в assert_valid, доступны в ex.error_log исключения
+        etree.DocumentInvalid. libxml2 не сообщает номера строк ошибок
+        потоковой проверки, в записях журнала line равен 0.
+        :param source: путь к файлу или файловый объект.
+        :param options: параметры разбора etree.iterparse (например, encoding).
+        """
+        events = etree.iterparse(source, events=('end',), schema=self.scheme,
+                                 remove_comments=True, huge_tree=True, **options)
+        try:
+            for _, element in events:
+                element.clear(keep_tail=True)
+                # Удаляем проверенные соседние элементы, оставшиеся у родителя
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        except etree.XMLSyntaxError as ex:
+            error_log = events.error_log
+            # Документ некорректен: ошибка разбора есть только в исключении
+            if not len(error_log):
+                error_log = [_SyntaxLogEntry(ex.lineno, ex.msg)]
+            raise etree.DocumentInvalid(str(ex), error_log)
@@ -1,8 +1,17 @@
 import os
+from io import BytesIO
+from typing import Union
 from lxml import etree
 from src.schemachecker.fns.tokenizer import Tokenizer
 from src.schemachecker.fns.interpreter import Interpreter
 from src.schemachecker.fns.fns_checker import FnsChecker
+from src.schemachecker.fns.utils import LRUCache
+from src.schemachecker.fns.index import DocumentIndex
+from src.schemachecker.fns.projection import Projection
+from src.schemachecker.fns.columnar import ColumnStore
+from src.schemachecker.fns.subexpressions import SubexpressionTable
+from src.schemachecker.fns.error_text import ErrorBatch
+from src.schemachecker.fns.exceptions import ParserError
 from tests.utils import assert_list_equality, get_file_list
 from tests.fns_tests.utils import Input  # .
 
@@ -43,6 +52,260 @@ class TestFnsInterpreter:
         for test in tests:
             print(self.interpreter.evaluate_expr(['usch:getFileName', '@ИдФайл', '='], test[1], test[0], ''))
 
+    def test_short_circuit(self):
+        xml_content = etree.fromstring('<Файл ИдФайл="1"><Документ КНД="1"/></Файл>')
+        missing = ['@Нет', '1', '=']
+
+        # Отсутствующий атрибут в невычисляемой ветви не приводит к ошибке
+        assert self.interpreter.evaluate_expr(['@КНД', '1', '=', *missing, 'or'],
+                                              xml_content, 'a.xml', 'Документ')
+        assert not self.interpreter.evaluate_expr(['@КНД', '2', '=', *missing, 'and'],
+                                                  xml_content, 'a.xml', 'Документ')
+        try:
+            self.interpreter.evaluate_expr(['@КНД', '1', '=', *missing, 'and'],
+                                           xml_content, 'a.xml', 'Документ')
+            assert False
+        except ParserError:
+            pass
+
+    def test_sum_nodes(self):
+        # sum() суммирует узлы всех контекстов документа и приводится к строке, как string(sum()) XPath
+        for values in (('1', '2'), ('0.1', '0.2'), ('1', 'x'), ('1e3', ' 2 '), ('-0.5', '0.5'),
+                       ('1234567890123', '1'), ('0.000001',), ()):
+            xml_content = etree.fromstring('<Файл>' + ''.join(f'<Док><Стр Сум="{value}">{value}</Стр></Док>'
+                                                              for value in values) + '</Файл>')
+            for node in ('Стр/@Сум', 'Стр'):
+                assert Interpreter().evaluate_expr([node, 'sum'], xml_content, 'a.xml', 'Док') == \
+                    xml_content.xpath(f'string(sum(//Док/{node}))'), (values, node)
+
+
+class TestFnsXPathInterpreter:
+    stack_checker = FnsChecker(root=root, engine='stack')
+    xpath_checker = FnsChecker(root=root, engine='xpath')
+    xml_file = 'NO_1.xml'
+    xml_content = etree.fromstring('<Файл ИдФайл="NO_1">'
+                                   '<Документ КНД="1" ИНН="10" Сум="9"><СвНП ИНН="1"/><СвНП ИНН="2"/></Документ>'
+                                   '<Документ КНД="2" ИНН="3" Сум="5"><СвНП ИНН="3"/></Документ></Файл>')
+
+    def _evaluate(self, checker: FnsChecker, context: str, expr: str) -> Union[bool, str]:
+        """ Вердикт движка, 'error' - выражение не вычислено. """
+        try:
+            return bool(checker.interpreter.evaluate_expr(checker._compile_expr(expr), self.xml_content,
+                                                          self.xml_file, context))
+        except ParserError:
+            return 'error'
+
+    def test_engines_verdicts(self):
+        """ Сравнение вердиктов интерпретатора и XPath движка на одном документе. """
+        tests = [
+            ('Файл', 'usch:getFileName() = @ИдФайл'),
+            ('Файл', 'substring(@ИдФайл, 1, 2) = \'NO\''),
+            ('Документ', '@КНД = 1'),
+            ('Документ', '@КНД != 2'),
+            ('Документ', '@ИНН = \'10\''),
+            ('Документ', 'not(@КНД = 2)'),
+            ('Документ', '@ИНН = 10 and @Сум = 9'),
+            ('Документ', '@КНД = 2 or @ИНН = 10'),
+            ('Документ', '@КНД = 1 or @Нет = 1'),
+            ('Документ', '@Сум >= 9'),
+            ('Документ', '@Сум <= 9'),
+            ('Документ', 'concat(@КНД, @ИНН) = \'110\''),
+            ('Документ', 'usch:iif(@КНД = 1, @ИНН = 10, @ИНН = 11)'),
+            ('Документ', 'usch:compareDate(@КНД, @КНД)'),
+            ('Документ', 'СвНП/@ИНН = 1'),
+            ('Документ', 'count(СвНП) > 1'),
+            ('Документ', 'count(Нет) = 0'),
+            ('Документ', 'sum(Нет/@ИНН) = 0'),
+        ]
+        for context, expr in tests:
+            assert self._evaluate(self.stack_checker, context, expr) == \
+                self._evaluate(self.xpath_checker, context, expr), expr
+
+    def test_engines_differences(self):
+        """ Известные расхождения движков (см. XPathInterpreter): (выражение, интерпретатор, XPath). """
+        tests = [
+            # Сравнение строк и чисел
+            ('@ИНН < 9', True, False),
+            ('@ИНН > 9', False, True),
+            ('@Сум > @ИНН', True, False),
+            # float результата арифметики сравнивается со строкой
+            ('@ИНН * 2 = 20', False, True),
+            # Отсутствующий атрибут
+            ('not(@Нет = 1) or @ИНН = 10', 'error', True),
+            ('@КНД = 2 or @Нет = 1', 'error', False),
+            # count по всем контекстам документа и по первому узлу контекста
+            ('count(СвНП) = 3', True, False),
+            ('count(СвНП) = 2', False, True),
+            ('sum(СвНП/@ИНН) = 6', True, False),
+            ('sum(СвНП/@ИНН) = 3', False, True),
+            # Операнды -, mod в лексере интерпретатора
+            ('@ИНН - 1 = 9', 'error', True),
+            ('@ИНН mod 3 = 1', 'error', True),
+        ]
+        for expr, stack_verdict, xpath_verdict in tests:
+            assert self._evaluate(self.stack_checker, 'Документ', expr) == stack_verdict, expr
+            assert self._evaluate(self.xpath_checker, 'Документ', expr) == xpath_verdict, expr
+
+
+class TestDocumentIndex:
+    def test_index_xpath_equality(self):
+        xml_content = etree.fromstring('<Файл ИдФайл="1"><Документ><СвНП ИНН="1"/><Св><СвНП/></Св>'
+                                       '<СвНП ИНН="2"><СвНП ИНН="3"/></СвНП></Документ></Файл>')
+        index = DocumentIndex.from_tree(xml_content)
+
+        for path in ('Файл', 'СвНП', 'Документ/СвНП', 'СвНП/СвНП', 'Файл/@ИдФайл', 'СвНП/@ИНН', 'Св/СвНП/@ИНН'):
+            steps, attr = DocumentIndex.split_path(path)
+            nodes = xml_content.xpath(f'//{path}')
+            if attr is None:
+                assert index.find(steps) == nodes
+            else:
+                assert index.values(steps, attr) == nodes
+            assert index.count(steps, attr) == len(nodes)
+
+        # Предикаты по индексу не разрешаются
+        assert DocumentIndex.split_path('СвНП[1]/@ИНН') is None
+
+
+class TestProjection:
+    def test_projection_index_equality(self):
+        xml = '<Файл ИдФайл="1"><Документ><СвНП ИНН="1"/><Св><СвНП/></Св><Лишний/>' \
+              '<СвНП ИНН="2"><СвНП ИНН="3"/></СвНП></Документ></Файл>'.encode()
+        rules = [{
+            'context': 'Документ',
+            'asserts': [{
+                'expr': ['СвНП/@ИНН', '\'1\'', '=', 'Св/СвНП', 'count', '0', '>', 'and'],
+                'error': {'replacing': [('СвНП/@ИНН', ['СвНП/@ИНН'])]}
+            }]
+        }]
+        projection = Projection.from_rules(rules, Interpreter())
+        index = projection.build(BytesIO(xml))
+        full_index = DocumentIndex.from_tree(etree.fromstring(xml))
+
+        # Сохраняются только пути плана проверок
+        assert set(index.ordinals) == {('Файл', 'Документ'), ('Файл', 'Документ', 'СвНП'),
+                                       ('Файл', 'Документ', 'Св', 'СвНП')}
+        for steps, attr in ((('Документ', 'СвНП'), 'ИНН'), (('Документ', 'Св', 'СвНП'), None),
+                            (('Документ',), None)):
+            assert index.count(steps, attr) == full_index.count(steps, attr)
+        assert index.values(('Документ', 'СвНП'), 'ИНН') == full_index.values(('Документ', 'СвНП'), 'ИНН')
+
+        # Пути с предикатами разрешаются только XPath по полному дереву
+        rules[0]['asserts'][0]['expr'] = ['СвНП[1]/@ИНН', '\'1\'', '=']
+        assert Projection.from_rules(rules, Interpreter()) is None
+
+    def test_projection_sum(self):
+        # sum() по проекции совпадает с вычислением по дереву, в том числе для нечисловых значений
+        for values, expected in ((('1', '2'), True), (('1', 'x'), False)):
+            xml = ('<Файл><Документ>' + ''.join(f'<Стр Сум="{value}"/>' for value in values) +
+                   '</Документ></Файл>').encode()
+            expr = ['Стр/@Сум', 'sum', '\'3\'', '=']
+            rules = [{'context': 'Документ', 'asserts': [{'expr': expr, 'error': {'replacing': []}}]}]
+            index = Projection.from_rules(rules, Interpreter()).build(BytesIO(xml))
+            for document in (index, etree.fromstring(xml)):
+                assert Interpreter().evaluate_expr(expr, document, 'file.xml', 'Документ') == expected
+
+        # Сумма значений элементов вычисляется только по полному дереву
+        rules[0]['asserts'][0]['expr'] = ['Стр', 'sum', '\'3\'', '=']
+        assert Projection.from_rules(rules, Interpreter()) is None
+
+
+class TestColumnStore:
+    def test_column_sums(self):
+        xml_content = etree.fromstring('<Файл><СвВыпл><МК Месяц="04" Сум="1.5"/><МК Месяц="05" Сум="2"/>'
+                                       '<МК Месяц="06"/></СвВыпл><СвВыпл><МК Месяц="05" Сум="3.25"/>'
+                                       '</СвВыпл></Файл>')
+        columns = ColumnStore(xml_content)
+
+        for expr in ('//СвВыпл/МК/@Сум', '/Файл/СвВыпл/МК[@Месяц="05"]/@Сум',
+                     '//МК[@Месяц="04" or @Месяц="05"]/@Сум', '//Файл//МК[@Месяц<6]/@Сум',
+                     '//МК[@Месяц>="05" and @Месяц!="05"]/@Сум'):
+            assert columns.sum(expr) == xml_content.xpath(f'sum({expr})'), expr
+            # Колонки по готовому индексу документа (интерпретатор, проекция)
+            assert ColumnStore(DocumentIndex.from_tree(xml_content)).sum(expr) == columns.sum(expr), expr
+
+        # Предикаты не последнего шага и значения элементов вычисляются через XPath
+        assert columns.sum('//СвВыпл[1]/МК/@Сум') is None
+        assert columns.sum('//СвВыпл/МК') is None
+
+
+class TestSubexpressionTable:
+    def test_shared_subexpressions(self):
+        tokenizer = Tokenizer()
+        parser = tokenizer.create_tokenizer()
+        xml_content = etree.fromstring('<Файл><Док ПрПодп="2" Итог="0"><СвПред/></Док></Файл>')
+        exprs = ['usch:iif(@ПрПодп=2, count(СвПред)!=0, count(СвПред)=0) or @Итог=0',
+                 'not(usch:iif(@ПрПодп=2, count(СвПред)!=0, count(СвПред)=0))',
+                 'count(СвПред)!=0 and @Нет=1']
+        rules = [{'context': 'Док',
+                  'asserts': [{'expr': tokenizer.tokenize_expression(expr, parser)} for expr in exprs]}]
+        report = SubexpressionTable.from_rules(rules, Interpreter()).report()
+        assert report['exprs'] == 3
+        assert ('Док', ('СвПред', 'count', '0', '!='), 3) in report['top']
+
+        # Вычисление с общими поддеревьями совпадает с обычным
+        interpreter = Interpreter()
+        for assertion in rules[0]['asserts']:
+            verdicts = []
+            for shared in (None, assertion['shared']):
+                try:
+                    verdicts.append(Interpreter().evaluate_expr(assertion['expr'], xml_content,
+                                                                'file.xml', 'Док', shared))
+                except ParserError:
+                    verdicts.append(ParserError)
+            assert verdicts[0] == verdicts[1]
+
+            try:
+                interpreter.evaluate_expr(assertion['expr'], xml_content, 'file.xml', 'Док',
+                                          assertion['shared'])
+            except ParserError:
+                pass
+        assert len(interpreter.memo) == report['shared']
+
+
+class TestErrorBatch:
+    def test_lazy_error_texts(self):
+        tokenizer = Tokenizer()
+        parser = tokenizer.create_tokenizer()
+        xml_content = etree.fromstring('<Файл><Док Итог="3"/></Файл>')
+        error = {'text': 'Итог @Итог неверен, @Нет',
+                 'replacing': [(select, tokenizer.tokenize_expression(select, parser))
+                               for select in ('@Итог', '@Нет')]}
+        interpreter = Interpreter()
+        error_texts = ErrorBatch(interpreter, xml_content, 'file.xml')
+        first = error_texts.add('Док', error)
+        second = error_texts.add('Док', error)
+
+        # Подстановки не вычисляются до обращения к тексту
+        assert interpreter.xml_content is None
+        # Невычисленная подстановка остаётся в тексте
+        assert str(first) == 'Итог 3 неверен, @Нет'
+        assert second == first and not error_texts.pending
+
+        # Формируются только переданные тексты, остальные при освобождении пакета
+        # сохраняют шаблон без подстановок
+        error_texts = ErrorBatch(Interpreter(), xml_content, 'file.xml')
+        first, second = error_texts.add('Док', error), error_texts.add('Док', error)
+        error_texts.render([first])
+        assert error_texts.pending == [second] and error_texts.document is not None
+        error_texts.release()
+        assert error_texts.document is None and not error_texts.pending
+        assert str(first) == 'Итог 3 неверен, @Нет' and str(second) == error['text']
+
+
+class TestLRUCache:
+    def test_lru_eviction(self):
+        cache = LRUCache(10)
+        cache.put('a', 1, weight=4)
+        cache.put('b', 2, weight=4)
+        # 'a' становится последним использованным, вытесняется 'b'
+        assert cache.get('a') == 1
+        cache.put('c', 3, weight=4)
+
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+        assert cache.size == 8
+        assert cache.get('b') is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
 
 class TestFnsChecker:
     checker = FnsChecker()
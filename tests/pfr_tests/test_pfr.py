@@ -1,9 +1,13 @@
 import os
+import socket
 import asyncio
+import pytest
 from lxml import etree
 from time import time
-from src.schemachecker.pfr.pfr_checker import PfrChecker
+from typing import List
+from src.schemachecker.pfr.pfr_checker import PfrChecker, PfrContext
 from src.schemachecker.pfr.xquery import Query, ExternalVar
+from src.schemachecker.pfr.exceptions import QueryMergeError
 from tests.utils import get_file_list
 from tests.pfr_tests.utils import Input
 
@@ -12,11 +16,18 @@ xsd_root = os.path.join(root, 'xsd')
 xml_root = os.path.join(root, 'xml')
 
 
+def basex_available(host: str = 'localhost', port: int = 1984) -> bool:
+    """ Доступность сервера BaseX для тестов, которым нужны сессии. """
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
 class TestPfrChecker:
     checker = PfrChecker(root=xsd_root)
     checker.setup_compendium()
-    # На тесте только одна бд, вручную изменяем поле класса для работы
-    checker.db_num = 1
 
     # TODO: use mock to simulate basex client
     def test_pfr_checker_szv(self):
@@ -44,6 +55,70 @@ class TestPfrChecker:
                 print(input.verify_result)
 
 
+class TestQuery:
+    prolog = ('declare default element namespace "http://pfr.ru";\n'
+              'declare variable $doc as xs:string external;\n'
+              'declare variable $document := fn:parse-xml($doc);\n')
+
+    def test_merge_renaming(self):
+        query = Query()
+        query.merge_query(self.prolog + 'declare variable $lim := 5;\n'
+                          '<БлокПроверок ID="1">{ $lim }</БлокПроверок>', 'v0')
+        query.merge_query(self.prolog + 'declare variable $lim := 7;\n'
+                          '<БлокПроверок ID="2">{ $lim }</БлокПроверок>', 'v1')
+        merged = query.makeup_query()
+
+        # Общие объявления не дублируются, конфликтующая переменная переименована
+        assert merged.count('declare variable $document') == 1
+        assert 'declare variable $lim_v1 := 7;' in merged
+        assert '<БлокПроверок ID="2">{ $lim_v1 }</БлокПроверок>' in merged
+        assert merged.count('<Валидатор>') == 2
+
+    def test_merge_fallback(self):
+        query = Query()
+        query.merge_query(self.prolog + '<БлокПроверок ID="1"/>', 'v0')
+        # Внешняя переменная связывается по имени и не переименовывается
+        with pytest.raises(QueryMergeError):
+            query.merge_query(self.prolog.replace('xs:string', 'xs:integer') + '<БлокПроверок ID="2"/>', 'v1')
+        assert len(query.blocks) == 1
+
+
+@pytest.mark.skipif(not basex_available(), reason='сервер BaseX недоступен')
+class TestFanout:
+    # Проверка выполняется на локальном экземпляре BaseX
+    query = ('declare default element namespace "http://pfr.ru";\n'
+             'declare variable $doc as xs:string external;\n'
+             'declare variable $document := fn:parse-xml($doc);\n'
+             '<БлокПроверок ID="{id}"><Проверка ID="1"><КодРезультата/>'
+             '<Описание>Ошибка { count($document//*) } {id}</Описание>'
+             '<РезультатЗапроса><Результат>1</Результат></РезультатЗапроса></Проверка></БлокПроверок>')
+
+    def _check(self, **kwargs) -> List[str]:
+        checker = PfrChecker(root=xsd_root, **kwargs)
+        try:
+            queries = {f'v{idx}.xquery': self.query.replace('{id}', f'V{idx}') for idx in range(6)}
+            checker.compendium = {direction: {'ПРЕФ': {'schemes': {}, 'queries': queries, 'definition': ''}}
+                                  for direction in checker.directions}
+            checker._set_doc_mode()
+            xml_data = '<Файл xmlns="http://pfr.ru"><Документ/></Файл>'
+            input = Input('PFR_ПРЕФ.xml', xml_data, etree.fromstring(xml_data))
+            input.verify_result = {'result': 'passed', 'asserts': []}
+            ctx = PfrContext(input)
+            ctx.content, ctx.prefix = xml_data, 'ПРЕФ'
+            checker._validate_xquery(ctx)
+            return [error['description'] for error in input.verify_result['asserts']]
+        finally:
+            # Сессии и базы данных пула удаляются с сервера
+            checker._finalize()
+
+    def test_fanout_order(self):
+        # Результаты сессий объединяются в порядке скриптов префикса
+        expected = [f'Ошибка 2 V{idx}' for idx in range(6)]
+        assert self._check() == expected
+        assert self._check(pool_size=3, fanout=3) == expected
+        assert self._check(pool_size=3, fanout=3, doc_mode='db') == expected
+
+
 # async def _test_new():
 #     for file in files:
 #         with open(os.path.join(szv_root, file), 'rb') as fd:
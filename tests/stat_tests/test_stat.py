@@ -0,0 +1,24 @@
+from src.schemachecker.stat.interpreter import Interpreter
+from src.schemachecker.stat.exceptions import EmptyExtract
+
+
+class EmptyFrame:
+    """ Секция, любая выборка из которой пуста. """
+    def get(self, *args):
+        raise EmptyExtract()
+
+
+class TestStatInterpreter:
+    interpreter = Interpreter()
+    frames = {'1': EmptyFrame()}
+    # Сравнение выборки строки 10 графы 3 первой секции с нулём
+    empty = [[['1'], ['10'], ['3']], 0, '|=|']
+
+    def test_empty_extract_operand(self):
+        # Пустая выборка в любом операнде and/or - контроль не применяется,
+        # даже если значение выражения определяется другим операндом
+        assert self.interpreter.evaluate_expr([1, 2, '|=|', *self.empty, 'and'], self.frames)
+        assert not self.interpreter.evaluate_expr_cond([1, 1, '|=|', *self.empty, 'or'], self.frames)
+
+        assert self.interpreter.evaluate_expr([1, 2, '|=|', 1, 1, '|=|', 'or'], {})
+        assert not self.interpreter.evaluate_expr([1, 2, '|=|', 1, 1, '|=|', 'and'], {})